@@ -1,9 +1,14 @@
-from flask import Flask, render_template, request, jsonify, redirect, url_for, session
+from flask import Flask, render_template, request, jsonify, redirect, url_for, session, Response, stream_with_context
 from flask_cors import CORS
 import os
 import json
+import uuid
 from datetime import datetime
-import processing2 as processing
+from werkzeug.utils import secure_filename
+import processing
+import exports
+import memory_governor
+import deadlines
 from dotenv import load_dotenv, find_dotenv
 
 """
@@ -154,6 +159,31 @@ def api_user():
         }), 401
 
 
+def _upload_path(filename):
+    """Unique path in the upload folder for a client-supplied file name."""
+    name, ext = os.path.splitext(secure_filename(filename))
+    timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
+    unique = f"{name or 'upload'}_{timestamp}_{uuid.uuid4().hex[:12]}{ext}"
+    return os.path.join(app.config['UPLOAD_FOLDER'], unique)
+
+
+def _remove_upload(filepath):
+    try:
+        os.remove(filepath)
+    except Exception:
+        pass
+
+
+def _timeout_response(results, filepath):
+    """Drop the upload of a request that ran out of time or was abandoned."""
+    _remove_upload(filepath)
+    return jsonify({
+        'success': False,
+        'error': results.get('error'),
+        'stage': results.get('stage')
+    }), 504
+
+
 @app.route('/api/upload', methods=['POST'])
 def api_upload():
     """Handle course material upload"""
@@ -185,27 +215,36 @@ def api_upload():
         }), 400
     
     if file and file.filename.lower().endswith('.pdf'):
-        filename = f"{subject_name}_{datetime.now().strftime('%Y%m%d_%H%M%S')}.pdf"
-        filepath = os.path.join(app.config['UPLOAD_FOLDER'], filename)
+        filepath = _upload_path(f"{subject_name}.pdf")
         file.save(filepath)
 
         # Analyze the uploaded PDF as an attendance sheet
-        try:
-            results = processing.process_pdf(filepath)
-            if isinstance(results, dict) and 'error' in results:
+        with memory_governor.job(memory_governor.estimate_job_bytes(filepath)) as rejected:
+            if rejected:
                 return jsonify({
                     'success': False,
-                    'error': results.get('error')
-                }), 400
-            return jsonify({
-                'success': True,
-                'data': results
-            })
-        except Exception as e:
-            return jsonify({
-                'success': False,
-                'message': f'Failed to analyze PDF: {str(e)}'
-            }), 500
+                    'error': rejected.get('error')
+                }), 503
+            try:
+                deadline = deadlines.from_request(request.environ, request.headers)
+                results = processing.process_image(filepath, subject_name, deadline)
+                if isinstance(results, dict) and results.get('timeout'):
+                    return _timeout_response(results, filepath)
+                if isinstance(results, dict) and 'error' in results:
+                    return jsonify({
+                        'success': False,
+                        'error': results.get('error')
+                    }), 400
+                results['report_id'] = exports.save_report(results)
+                return jsonify({
+                    'success': True,
+                    'data': results
+                })
+            except Exception as e:
+                return jsonify({
+                    'success': False,
+                    'message': f'Failed to analyze PDF: {str(e)}'
+                }), 500
     else:
         return jsonify({
             'success': False,
@@ -232,30 +271,133 @@ def api_process():
         }), 400
 
     # Save the uploaded file
-    name, ext = os.path.splitext(file.filename)
-    timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
-    safe_name = f"{name}_{timestamp}{ext}"
-    filepath = os.path.join(app.config['UPLOAD_FOLDER'], safe_name)
+    filepath = _upload_path(file.filename)
     file.save(filepath)
 
     # Delegate processing to the processing module
-    try:
-        results = processing.process_image(filepath)
-        # processing.process_image returns a dict; include success flag for consistency
-        if isinstance(results, dict) and 'error' in results:
+    with memory_governor.job(memory_governor.estimate_job_bytes(filepath)) as rejected:
+        if rejected:
             return jsonify({
                 'success': False,
-                'error': results.get('error')
-            }), 400
+                'error': rejected.get('error')
+            }), 503
+        try:
+            deadline = deadlines.from_request(request.environ, request.headers)
+            results = processing.process_image(filepath, deadline=deadline)
+            # processing.process_image returns a dict; include success flag for consistency
+            if isinstance(results, dict) and results.get('timeout'):
+                return _timeout_response(results, filepath)
+            if isinstance(results, dict) and 'error' in results:
+                return jsonify({
+                    'success': False,
+                    'error': results.get('error')
+                }), 400
+            results['report_id'] = exports.save_report(results)
+            return jsonify({
+                'success': True,
+                'data': results
+            })
+        except Exception as e:
+            return jsonify({
+                'success': False,
+                'message': f'Failed to process image: {str(e)}'
+            }), 500
+
+
+@app.route('/api/process/batch', methods=['POST'])
+def api_process_batch():
+    """Process several attendance sheets at once; photos needing Gemini share requests."""
+    files = [f for f in request.files.getlist('files') if f and f.filename]
+    if not files:
         return jsonify({
-            'success': True,
-            'data': results
-        })
-    except Exception as e:
+            'success': False,
+            'message': "No files in the request; expected one or more 'files' fields"
+        }), 400
+
+    filepaths = []
+    for file in files:
+        filepath = _upload_path(file.filename)
+        file.save(filepath)
+        filepaths.append(filepath)
+
+    estimate = sum(memory_governor.estimate_job_bytes(p) for p in filepaths)
+    with memory_governor.job(estimate) as rejected:
+        if rejected:
+            return jsonify({
+                'success': False,
+                'error': rejected.get('error')
+            }), 503
+        try:
+            deadline = deadlines.from_request(request.environ, request.headers)
+            batch = processing.process_images(filepaths, deadline)
+        except Exception as e:
+            return jsonify({
+                'success': False,
+                'message': f'Failed to process images: {str(e)}'
+            }), 500
+
+    items = []
+    for file, filepath, results in zip(files, filepaths, batch):
+        if isinstance(results, dict) and results.get('timeout'):
+            # Sheets the request ran out of time (or was abandoned) for are dropped.
+            _remove_upload(filepath)
+            items.append({'file': file.filename, 'success': False, 'error': results.get('error'),
+                          'stage': results.get('stage')})
+        elif isinstance(results, dict) and 'error' in results:
+            items.append({'file': file.filename, 'success': False, 'error': results.get('error')})
+        else:
+            results['report_id'] = exports.save_report(results)
+            items.append({'file': file.filename, 'success': True, 'data': results})
+    timed_out = all(isinstance(r, dict) and r.get('timeout') for r in batch)
+    return jsonify({
+        'success': any(item['success'] for item in items),
+        'results': items
+    }), 504 if timed_out else 200
+
+
+@app.route('/api/reports/<report_id>/export/<fmt>')
+def api_export_report(report_id, fmt):
+    """Stream a stored attendance report as CSV, XLSX or Parquet."""
+    exported = exports.export_report(report_id, fmt)
+    if isinstance(exported, dict) and 'error' in exported:
+        return jsonify({
+            'success': False,
+            'error': exported.get('error')
+        }), exported.get('status', 400)
+
+    chunks, mimetype = exported
+    filename = f"attendance_{report_id}.{fmt.lower()}"
+    return Response(
+        stream_with_context(chunks),
+        mimetype=mimetype,
+        headers={'Content-Disposition': f'attachment; filename="{filename}"'}
+    )
+
+
+@app.route('/api/debug/memory')
+def api_debug_memory():
+    """tracemalloc snapshot of this worker (requires MEMORY_DEBUG=1 and a teacher session)."""
+    if not memory_governor.MEMORY_DEBUG:
+        return jsonify({
+            'success': False,
+            'message': 'Not found'
+        }), 404
+    if 'user' not in session or session['user']['role'] != 'teacher':
+        return jsonify({
+            'success': False,
+            'message': 'Teacher access required'
+        }), 403
+    limit = request.args.get('limit', 25, type=int)
+    report = memory_governor.snapshot_report(limit)
+    if 'error' in report:
         return jsonify({
             'success': False,
-            'message': f'Failed to process image: {str(e)}'
-        }), 500
+            'error': report.get('error')
+        }), 400
+    return jsonify({
+        'success': True,
+        'data': report
+    })
 
 
 # Backward-compatibility: support the old FastAPI-style endpoint path
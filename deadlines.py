@@ -0,0 +1,103 @@
+import os
+import time
+import select
+import socket
+from typing import Callable, Dict, Any
+
+from dotenv import load_dotenv, find_dotenv
+
+# ---------- Env ----------
+dotenv_path = os.path.join(os.path.dirname(__file__), '.env')
+if not os.path.exists(dotenv_path):
+    dotenv_path = find_dotenv()
+if dotenv_path:
+    load_dotenv(dotenv_path)
+
+# Time budget for one processing request. Clients may only shorten it through
+# the X-Request-Timeout header. Keep it below gunicorn's worker timeout.
+REQUEST_DEADLINE_S = float(os.getenv('REQUEST_DEADLINE_S', '120'))
+
+
+class DeadlineExceeded(Exception):
+    """Raised at a pipeline checkpoint once the request's deadline has passed or it was cancelled."""
+
+    def __init__(self, stage: str, cancelled: bool = False):
+        self.stage = stage
+        self.cancelled = cancelled
+        reason = 'client disconnected' if cancelled else 'time budget exhausted'
+        super().__init__(f"Processing stopped during {stage}: {reason}.")
+
+
+class Deadline:
+    """Per-request time budget plus cancellation, checked between pipeline stages."""
+
+    def __init__(self, budget_s: float, is_disconnected: Callable[[], bool] | None = None):
+        self.budget_s = budget_s
+        self.expires_at = time.monotonic() + budget_s
+        self._is_disconnected = is_disconnected
+        self._cancelled = False
+
+    def remaining(self) -> float:
+        return max(0.0, self.expires_at - time.monotonic())
+
+    def expired(self) -> bool:
+        return time.monotonic() >= self.expires_at
+
+    def cancelled(self) -> bool:
+        if not self._cancelled and self._is_disconnected is not None:
+            try:
+                self._cancelled = self._is_disconnected()
+            except Exception:
+                pass
+        return self._cancelled
+
+    def cancel(self) -> None:
+        self._cancelled = True
+
+    def check(self, stage: str) -> None:
+        """Raise DeadlineExceeded if the request was cancelled or ran out of time."""
+        if self.cancelled():
+            raise DeadlineExceeded(stage, cancelled=True)
+        if self.expired():
+            raise DeadlineExceeded(stage)
+
+
+def _socket_closed(sock: socket.socket) -> bool:
+    # A readable socket that returns no bytes means the peer has closed it.
+    # Readability is checked first with a zero timeout: under gevent workers
+    # recv() waits for data whatever the flags, so it must only be called
+    # when it cannot block.
+    try:
+        readable, _, _ = select.select([sock], [], [], 0)
+        if not readable:
+            return False
+        data = sock.recv(1, socket.MSG_PEEK | socket.MSG_DONTWAIT)
+        return data == b''
+    except (BlockingIOError, InterruptedError):
+        return False
+    except (OSError, ValueError):
+        return True
+
+
+def from_request(environ: Dict[str, Any], headers) -> Deadline:
+    """Build the deadline for an incoming request.
+
+    The budget is REQUEST_DEADLINE_S unless the client or proxy sends a shorter
+    X-Request-Timeout in seconds; longer values are ignored.
+    Under gunicorn the client socket is probed so a disconnect cancels the work.
+    """
+    budget = REQUEST_DEADLINE_S
+    try:
+        requested = float(headers.get('X-Request-Timeout', ''))
+        if requested > 0:
+            budget = min(requested, REQUEST_DEADLINE_S)
+    except ValueError:
+        pass
+
+    sock = environ.get('gunicorn.socket')
+    is_disconnected = (lambda: _socket_closed(sock)) if sock is not None else None
+    return Deadline(budget, is_disconnected)
+
+
+def timeout_error(exc: DeadlineExceeded) -> Dict[str, Any]:
+    return {"error": str(exc), "timeout": True, "stage": exc.stage, "cancelled": exc.cancelled}
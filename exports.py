@@ -0,0 +1,252 @@
+import os
+import io
+import csv
+import json
+import re
+import time
+import uuid
+import tempfile
+from typing import List, Dict, Any, Iterator, Tuple
+
+from dotenv import load_dotenv, find_dotenv
+
+# ---------- Env ----------
+dotenv_path = os.path.join(os.path.dirname(__file__), '.env')
+if not os.path.exists(dotenv_path):
+    dotenv_path = find_dotenv()
+if dotenv_path:
+    load_dotenv(dotenv_path)
+
+REPORTS_FOLDER = os.getenv('REPORTS_FOLDER', os.path.join(os.getenv('UPLOAD_FOLDER', 'uploads'), 'reports'))
+# Stored reports older than REPORTS_MAX_AGE_DAYS, or beyond the newest
+# REPORTS_MAX_COUNT, are deleted when a new report is saved (0 disables either limit).
+REPORTS_MAX_AGE_DAYS = float(os.getenv('REPORTS_MAX_AGE_DAYS', '30'))
+REPORTS_MAX_COUNT = int(os.getenv('REPORTS_MAX_COUNT', '5000'))
+EXPORT_BATCH_ROWS = int(os.getenv('EXPORT_BATCH_ROWS', '1000'))
+EXPORT_CHUNK_BYTES = 64 * 1024
+
+LEADING_COLUMNS = ['Roll No', 'Student ID', 'Name']
+TRAILING_COLUMNS = ['Total Lectures', 'Lectures Attended', 'Percentage', 'Status', 'Anomaly']
+
+EXPORT_FORMATS = {
+    'csv': 'text/csv',
+    'xlsx': 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet',
+    'parquet': 'application/vnd.apache.parquet',
+}
+
+_REPORT_ID_RE = re.compile(r'^[0-9a-f]{32}$')
+
+
+# ---------- Report store ----------
+# Reports are kept on disk as JSON lines: a header line with the column order,
+# then one line per student. Exports read them back one row at a time, so a
+# stored report can be re-exported in any format without re-running OCR and
+# without loading the whole cohort into memory.
+
+def _report_path(report_id: str) -> str | None:
+    if not _REPORT_ID_RE.match(report_id or ''):
+        return None
+    return os.path.join(REPORTS_FOLDER, f"{report_id}.jsonl")
+
+
+def report_columns(dates: List[str]) -> List[str]:
+    """Column order used by the Full Report table in courses.html."""
+    return LEADING_COLUMNS + list(dates or []) + TRAILING_COLUMNS
+
+
+def save_report(results: Dict[str, Any]) -> str:
+    """Persist a `_build_reports_from_dataframe` result and return its report id."""
+    os.makedirs(REPORTS_FOLDER, exist_ok=True)
+    report_id = uuid.uuid4().hex
+    dates = [str(d) for d in results.get('dates', [])]
+    path = _report_path(report_id)
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w', encoding='utf-8') as fh:
+        fh.write(json.dumps({'dates': dates, 'columns': report_columns(dates)}) + '\n')
+        for row in results.get('full_report', []):
+            fh.write(json.dumps(row, default=str) + '\n')
+    os.replace(tmp_path, path)
+    prune_reports()
+    return report_id
+
+
+def prune_reports() -> int:
+    """Delete reports past REPORTS_MAX_AGE_DAYS or beyond the newest REPORTS_MAX_COUNT."""
+    try:
+        entries = [(e.stat().st_mtime, e.path) for e in os.scandir(REPORTS_FOLDER)
+                   if e.is_file() and e.name.endswith('.jsonl')]
+    except OSError:
+        return 0
+    entries.sort(reverse=True)
+    cutoff = time.time() - REPORTS_MAX_AGE_DAYS * 86400 if REPORTS_MAX_AGE_DAYS > 0 else None
+    removed = 0
+    for i, (mtime, path) in enumerate(entries):
+        too_many = REPORTS_MAX_COUNT > 0 and i >= REPORTS_MAX_COUNT
+        too_old = cutoff is not None and mtime < cutoff
+        if too_many or too_old:
+            try:
+                os.remove(path)
+                removed += 1
+            except OSError:
+                pass
+    return removed
+
+
+def load_report_header(report_id: str) -> Dict[str, Any] | None:
+    path = _report_path(report_id)
+    if not path or not os.path.exists(path):
+        return None
+    with open(path, 'r', encoding='utf-8') as fh:
+        return json.loads(fh.readline())
+
+
+def iter_report_rows(report_id: str) -> Iterator[List[Any]]:
+    """Yield each stored student row as a list ordered like the header columns."""
+    path = _report_path(report_id)
+    with open(path, 'r', encoding='utf-8') as fh:
+        columns = json.loads(fh.readline())['columns']
+        for line in fh:
+            if not line.strip():
+                continue
+            record = json.loads(line)
+            yield [record.get(c, '') for c in columns]
+
+
+def _iter_batches(rows: Iterator[List[Any]], size: int) -> Iterator[List[List[Any]]]:
+    batch: List[List[Any]] = []
+    for row in rows:
+        batch.append(row)
+        if len(batch) >= size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+# ---------- Format writers ----------
+
+class _DrainBuffer(io.RawIOBase):
+    """Write-only sink whose contents are handed out and cleared after each batch."""
+
+    def __init__(self):
+        super().__init__()
+        self._buf = bytearray()
+        self._pos = 0
+
+    def writable(self) -> bool:
+        return True
+
+    def write(self, b) -> int:
+        self._buf.extend(b)
+        self._pos += len(b)
+        return len(b)
+
+    def tell(self) -> int:
+        return self._pos
+
+    def drain(self) -> bytes:
+        data = bytes(self._buf)
+        self._buf.clear()
+        return data
+
+
+def stream_csv(report_id: str) -> Iterator[bytes]:
+    header = load_report_header(report_id)
+    buf = io.StringIO()
+    writer = csv.writer(buf)
+    writer.writerow(header['columns'])
+    for batch in _iter_batches(iter_report_rows(report_id), EXPORT_BATCH_ROWS):
+        writer.writerows(batch)
+        yield buf.getvalue().encode('utf-8')
+        buf.seek(0)
+        buf.truncate(0)
+    if buf.tell():
+        yield buf.getvalue().encode('utf-8')
+
+
+def stream_parquet(report_id: str) -> Iterator[bytes]:
+    # pyarrow is only needed for this format, so keep it out of module import.
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    header = load_report_header(report_id)
+    columns = header['columns']
+    numeric = {'Total Lectures': pa.int64(), 'Lectures Attended': pa.int64(), 'Percentage': pa.float64()}
+    schema = pa.schema([(c, numeric.get(c, pa.string())) for c in columns])
+
+    sink = _DrainBuffer()
+    writer = pq.ParquetWriter(sink, schema)
+    try:
+        wrote_any = False
+        for batch in _iter_batches(iter_report_rows(report_id), EXPORT_BATCH_ROWS):
+            arrays = []
+            for i, c in enumerate(columns):
+                values = [row[i] for row in batch]
+                if c in numeric:
+                    arrays.append(pa.array([None if v in ('', None) else v for v in values], type=numeric[c]))
+                else:
+                    arrays.append(pa.array([None if v is None else str(v) for v in values], type=pa.string()))
+            # Each batch becomes its own row group, so nothing accumulates between batches.
+            writer.write_table(pa.Table.from_arrays(arrays, schema=schema))
+            wrote_any = True
+            chunk = sink.drain()
+            if chunk:
+                yield chunk
+        if not wrote_any:
+            writer.write_table(schema.empty_table())
+    finally:
+        writer.close()
+    tail = sink.drain()
+    if tail:
+        yield tail
+
+
+def stream_xlsx(report_id: str) -> Iterator[bytes]:
+    # XLSX is a zip container, so the workbook is written row-by-row in
+    # openpyxl's write-only mode to a temp file and then streamed out in chunks.
+    from openpyxl import Workbook
+
+    header = load_report_header(report_id)
+    wb = Workbook(write_only=True)
+    ws = wb.create_sheet('Full Report')
+    ws.append(header['columns'])
+    for row in iter_report_rows(report_id):
+        ws.append(row)
+
+    fd, tmp_path = tempfile.mkstemp(suffix='.xlsx')
+    os.close(fd)
+    try:
+        wb.save(tmp_path)
+        with open(tmp_path, 'rb') as fh:
+            while True:
+                chunk = fh.read(EXPORT_CHUNK_BYTES)
+                if not chunk:
+                    break
+                yield chunk
+    finally:
+        try:
+            os.remove(tmp_path)
+        except Exception:
+            pass
+
+
+_STREAMERS = {
+    'csv': stream_csv,
+    'xlsx': stream_xlsx,
+    'parquet': stream_parquet,
+}
+
+
+def export_report(report_id: str, fmt: str) -> Tuple[Iterator[bytes], str] | Dict[str, Any]:
+    """Return (chunk generator, mimetype) for a stored report, or an error dict.
+
+    Error dicts carry the HTTP `status` the route should answer with.
+    """
+    fmt = (fmt or '').lower()
+    if fmt not in _STREAMERS:
+        return {"error": f"Unsupported export format '{fmt}'. Use one of: {', '.join(EXPORT_FORMATS)}.",
+                "status": 400}
+    if load_report_header(report_id) is None:
+        return {"error": "Report not found. Process the sheet again to create a new report.",
+                "status": 404}
+    return _STREAMERS[fmt](report_id), EXPORT_FORMATS[fmt]
@@ -0,0 +1,27 @@
+# Gunicorn settings picked up automatically when gunicorn is started from this directory.
+# Command-line flags (e.g. --workers) still take precedence.
+import os
+
+bind = f"{os.getenv('HOST', '0.0.0.0')}:{os.getenv('PORT', '5000')}"
+workers = int(os.getenv('WEB_CONCURRENCY', '2'))
+# With the default of 1 thread these are sync workers serving one request at a
+# time, so memory_governor's per-worker admission budget never refuses a job.
+# Raise GUNICORN_THREADS (gthread workers) to serve uploads concurrently.
+threads = int(os.getenv('GUNICORN_THREADS', '1'))
+timeout = int(os.getenv('GUNICORN_TIMEOUT', '300'))
+
+
+def post_fork(server, worker):
+    # Tell the app whether this worker serves requests concurrently; Gemini
+    # sheet batching (GEMINI_BATCH=auto) only pays off when it does.
+    concurrent = worker.cfg.threads > 1 or worker.cfg.worker_class_str != 'sync'
+    os.environ['WORKER_CONCURRENT'] = '1' if concurrent else '0'
+
+
+def post_request(worker, req, environ, resp):
+    # Let the worker finish this request and exit gracefully once it has done
+    # enough OCR jobs or grown past its RSS ceiling; the master replaces it.
+    import memory_governor
+    if worker.alive and memory_governor.should_recycle():
+        worker.log.info("Recycling worker %s: %s", worker.pid, memory_governor.status())
+        worker.alive = False
@@ -0,0 +1,211 @@
+import os
+import re
+import json
+import tempfile
+import threading
+from datetime import datetime
+from typing import List, Dict, Any
+
+import numpy as np
+import cv2
+from dotenv import load_dotenv, find_dotenv
+
+# ---------- Env ----------
+dotenv_path = os.path.join(os.path.dirname(__file__), '.env')
+if not os.path.exists(dotenv_path):
+    dotenv_path = find_dotenv()
+if dotenv_path:
+    load_dotenv(dotenv_path)
+
+# Per-subject cache of detected table layouts. The same register format is
+# uploaded every week, so once a subject's grid and column kinds have been found
+# the next upload only needs a cheap alignment against the cached ruling lines.
+# Header labels are not cached: each week's register carries new lecture dates.
+LAYOUT_CACHE = os.getenv('LAYOUT_CACHE', '1') in ('1', 'true', 'True')
+LAYOUT_CACHE_FOLDER = os.getenv('LAYOUT_CACHE_FOLDER', os.path.join(os.getenv('UPLOAD_FOLDER', 'uploads'), 'layouts'))
+LAYOUT_TEMPLATES_PER_SUBJECT = int(os.getenv('LAYOUT_TEMPLATES_PER_SUBJECT', '3'))
+# Max Hamming distance between page fingerprints for a template to be considered.
+LAYOUT_HASH_DISTANCE = int(os.getenv('LAYOUT_HASH_DISTANCE', '12'))
+# Min correlation of ruling-line profiles after alignment; below this the layout has drifted.
+LAYOUT_MIN_SCORE = float(os.getenv('LAYOUT_MIN_SCORE', '0.85'))
+
+PROFILE_STEP = 4
+MAX_SHIFT_FRACTION = 0.05
+
+# subject -> (mtime_ns of its file when read, templates). Other workers write
+# the same files, so an entry is re-read once the file changes.
+_templates: Dict[str, tuple] = {}
+_lock = threading.Lock()
+
+
+# ---------- Fingerprint and registration ----------
+
+def page_fingerprint(img_bin: np.ndarray) -> int:
+    """64-bit difference hash of the page; near-identical layouts give nearby hashes."""
+    small = cv2.resize(img_bin, (9, 8), interpolation=cv2.INTER_AREA).astype(np.int16)
+    bits = (small[:, 1:] > small[:, :-1]).flatten()
+    return int(sum(1 << i for i, b in enumerate(bits) if b))
+
+
+def _hamming(a: int, b: int) -> int:
+    return bin(a ^ b).count('1')
+
+
+def _downsample(profile: np.ndarray) -> np.ndarray:
+    n = len(profile) // PROFILE_STEP * PROFILE_STEP
+    return profile[:n].reshape(-1, PROFILE_STEP).sum(axis=1)
+
+
+def line_profiles(img_bin: np.ndarray) -> tuple:
+    """Row profile of horizontal ruling lines and column profile of vertical ones."""
+    H, W = img_bin.shape[:2]
+    horiz_kernel = cv2.getStructuringElement(cv2.MORPH_RECT, (max(10, W // 30), 1))
+    vert_kernel = cv2.getStructuringElement(cv2.MORPH_RECT, (1, max(10, H // 30)))
+    horiz = cv2.morphologyEx(img_bin, cv2.MORPH_OPEN, horiz_kernel)
+    vert = cv2.morphologyEx(img_bin, cv2.MORPH_OPEN, vert_kernel)
+    rows = horiz.sum(axis=1, dtype=np.float64) / 255.0
+    cols = vert.sum(axis=0, dtype=np.float64) / 255.0
+    return _downsample(rows), _downsample(cols)
+
+
+def _best_shift(ref: np.ndarray, cur: np.ndarray) -> tuple:
+    """Return (shift, correlation) maximizing the correlation of cur[i + shift] with ref[i]."""
+    n = min(len(ref), len(cur))
+    ref, cur = ref[:n], cur[:n]
+    max_shift = max(1, int(n * MAX_SHIFT_FRACTION))
+    best = (0, -1.0)
+    for s in range(-max_shift, max_shift + 1):
+        a = ref[:n - s] if s >= 0 else ref[-s:]
+        b = cur[s:] if s >= 0 else cur[:n + s]
+        if a.std() == 0 or b.std() == 0:
+            continue
+        score = float(np.corrcoef(a, b)[0, 1])
+        if score > best[1]:
+            best = (s, score)
+    return best
+
+
+# ---------- Store ----------
+
+def _subject_path(subject: str) -> str:
+    safe = re.sub(r'[^A-Za-z0-9_-]', '_', subject.strip())
+    return os.path.join(LAYOUT_CACHE_FOLDER, f"{safe}.json")
+
+
+def _file_mtime(path: str) -> int | None:
+    try:
+        return os.stat(path).st_mtime_ns
+    except OSError:
+        return None
+
+
+def _load_subject(subject: str) -> List[Dict[str, Any]]:
+    path = _subject_path(subject)
+    mtime = _file_mtime(path)
+    cached = _templates.get(subject)
+    if cached is not None and cached[0] == mtime:
+        return cached[1]
+    templates: List[Dict[str, Any]] = []
+    if mtime is not None:
+        try:
+            with open(path, 'r', encoding='utf-8') as fh:
+                templates = json.load(fh)
+        except Exception:
+            templates = []
+    _templates[subject] = (mtime, templates)
+    return templates
+
+
+def store_template(subject: str, img_bin: np.ndarray, box_rows: List[List[tuple]],
+                   kinds: List[str]) -> None:
+    """Remember a freshly detected grid and its column kinds for this subject.
+
+    Writing the file is best-effort: if it fails, the template is still kept
+    in this worker's memory and the upload carries on.
+    """
+    if not LAYOUT_CACHE or not subject or len(box_rows) < 2:
+        return
+    rows, cols = line_profiles(img_bin)
+    template = {
+        'hash': page_fingerprint(img_bin),
+        'shape': list(img_bin.shape[:2]),
+        'row_profile': [round(float(v), 1) for v in rows],
+        'col_profile': [round(float(v), 1) for v in cols],
+        'box_rows': [[list(map(int, box)) for box in row] for row in box_rows],
+        'kinds': kinds,
+        'created': datetime.now().isoformat(timespec='seconds'),
+    }
+    with _lock:
+        # Merge with the latest file so templates saved by other workers are kept.
+        templates = [template] + _load_subject(subject)
+        templates = templates[:LAYOUT_TEMPLATES_PER_SUBJECT]
+        path = _subject_path(subject)
+        mtime = _templates[subject][0]
+        try:
+            os.makedirs(LAYOUT_CACHE_FOLDER, exist_ok=True)
+            fd, tmp_path = tempfile.mkstemp(dir=LAYOUT_CACHE_FOLDER, suffix='.tmp')
+            try:
+                with os.fdopen(fd, 'w', encoding='utf-8') as fh:
+                    json.dump(templates, fh)
+                os.replace(tmp_path, path)
+            except Exception:
+                try:
+                    os.remove(tmp_path)
+                except OSError:
+                    pass
+                raise
+            mtime = _file_mtime(path)
+        except Exception:
+            pass
+        _templates[subject] = (mtime, templates)
+
+
+def match_template(subject: str, img_bin: np.ndarray) -> Dict[str, Any]:
+    """Look up a cached layout for this page.
+
+    Returns a dict whose 'status' is 'hit' (with aligned 'box_rows' and
+    'kinds'), 'miss' (no comparable template) or 'drift' (a template was
+    close by fingerprint but its ruling lines no longer line up).
+    """
+    if not LAYOUT_CACHE or not subject:
+        return {'status': 'disabled'}
+
+    H, W = img_bin.shape[:2]
+    fingerprint = page_fingerprint(img_bin)
+    with _lock:
+        candidates = [
+            t for t in _load_subject(subject)
+            if abs(t['shape'][0] - H) <= H * 0.02 and abs(t['shape'][1] - W) <= W * 0.02
+            and _hamming(t['hash'], fingerprint) <= LAYOUT_HASH_DISTANCE
+        ]
+    if not candidates:
+        return {'status': 'miss'}
+
+    rows, cols = line_profiles(img_bin)
+    best = None
+    for t in sorted(candidates, key=lambda t: _hamming(t['hash'], fingerprint)):
+        dy, row_score = _best_shift(np.asarray(t['row_profile']), rows)
+        dx, col_score = _best_shift(np.asarray(t['col_profile']), cols)
+        score = min(row_score, col_score)
+        if best is None or score > best[0]:
+            best = (score, dx * PROFILE_STEP, dy * PROFILE_STEP, t)
+
+    score, dx, dy, t = best
+    if score < LAYOUT_MIN_SCORE:
+        return {'status': 'drift', 'score': round(score, 3)}
+
+    box_rows = []
+    for row in t['box_rows']:
+        shifted = []
+        for x, y, w, h in row:
+            x = min(max(0, x + dx), W - 1)
+            y = min(max(0, y + dy), H - 1)
+            shifted.append((x, y, min(w, W - x), min(h, H - y)))
+        box_rows.append(shifted)
+    return {
+        'status': 'hit',
+        'score': round(score, 3),
+        'shift': [dx, dy],
+        'box_rows': box_rows,
+        'kinds': list(t['kinds']),
+    }
@@ -0,0 +1,427 @@
+"""
+End-to-end load test for the Flask app running under gunicorn.
+
+Starts the app locally with Gemini stubbed out (canned responses via
+GEMINI_STUB_DIR), replays a mix of /api/login, /api/upload, /api/process and
+/upload requests built from synthetic attendance sheets, and reports
+throughput, p50/p95/p99 latency, error rates and per-worker RSS. Each run is
+saved as JSON under loadtest_results/ so builds can be compared.
+The gevent worker class needs `pip install gevent`.
+
+Examples:
+    python loadtest.py --worker-class sync --workers 2 --duration 60
+    python loadtest.py --worker-class gthread --workers 2 --threads 4 --concurrency 16
+    python loadtest.py --worker-class gevent --compare loadtest_results/<previous>.json
+"""
+import os
+import sys
+import json
+import time
+import uuid
+import random
+import shutil
+import argparse
+import tempfile
+import threading
+import subprocess
+import http.cookiejar
+import urllib.request
+import urllib.error
+from datetime import datetime
+from typing import List, Dict, Any
+
+from PIL import Image, ImageDraw
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+RESULTS_FOLDER = os.path.join(BASE_DIR, 'loadtest_results')
+
+DEFAULT_MIX = 'login=1,api_upload=3,api_process=3,upload=1'
+CACHE_SETTINGS = ('pipeline_cache_size', 'layout_cache')
+TEACHER = {'email': 'admin@example.com', 'password': 'admin123'}
+
+
+# ---------- Synthetic sheets ----------
+
+def make_sheet(path: str, students: int = 30, dates: int = 8, seed: int = 0) -> Dict[str, Any]:
+    """Draw a ruled attendance sheet (PNG or PDF by extension) and return its ground truth."""
+    rnd = random.Random(seed)
+    date_labels = [f"{d + 1:02d}/08" for d in range(dates)]
+    col_widths = [140, 380] + [110] * dates
+    row_h = 56
+    width = sum(col_widths) + 80
+    height = row_h * (students + 1) + 80
+
+    img = Image.new('L', (width, height), 255)
+    draw = ImageDraw.Draw(img)
+    records = []
+    header = ['Roll No', 'Name'] + date_labels
+    for r in range(students + 1):
+        y = 40 + r * row_h
+        x = 40
+        if r == 0:
+            cells = header
+        else:
+            attendance = ['P' if rnd.random() < 0.8 else 'A' for _ in date_labels]
+            name = f"Student {r:03d}"
+            records.append({
+                'roll_no': str(r), 'student_id': '', 'name': name,
+                'attendance': ['Present' if a == 'P' else 'Absent' for a in attendance],
+            })
+            cells = [str(r), name] + attendance
+        for text, w in zip(cells, col_widths):
+            draw.rectangle([x, y, x + w, y + row_h], outline=0, width=2)
+            draw.text((x + 10, y + row_h // 3), text, fill=0)
+            x += w
+
+    if path.lower().endswith('.pdf'):
+        img.convert('RGB').save(path, 'PDF', resolution=150)
+    else:
+        img.save(path)
+    return {'dates': date_labels, 'students': records}
+
+
+def prepare_fixtures(work_dir: str, students: int, dates: int) -> Dict[str, str]:
+    """Write synthetic sheets and the Gemini stub responses they correspond to."""
+    stub_dir = os.path.join(work_dir, 'gemini_stub')
+    os.makedirs(stub_dir, exist_ok=True)
+    pdf_path = os.path.join(work_dir, 'sheet.pdf')
+    png_path = os.path.join(work_dir, 'sheet.png')
+    truth = make_sheet(pdf_path, students, dates, seed=1)
+    make_sheet(png_path, students, dates, seed=1)
+    with open(os.path.join(stub_dir, 'sheet.json'), 'w', encoding='utf-8') as fh:
+        json.dump(truth, fh)
+    with open(os.path.join(stub_dir, 'batch.json'), 'w', encoding='utf-8') as fh:
+        json.dump({'sheets': [dict(truth, sheet=i) for i in range(16)]}, fh)
+    with open(os.path.join(stub_dir, 'cells.json'), 'w', encoding='utf-8') as fh:
+        json.dump({'cells': []}, fh)
+    return {'pdf': pdf_path, 'png': png_path, 'stub_dir': stub_dir}
+
+
+# ---------- HTTP client ----------
+
+def _multipart(fields: Dict[str, str], files: Dict[str, str]) -> tuple:
+    boundary = uuid.uuid4().hex
+    parts = []
+    for name, value in fields.items():
+        parts.append(
+            f'--{boundary}\r\nContent-Disposition: form-data; name="{name}"\r\n\r\n{value}\r\n'.encode()
+        )
+    for name, path in files.items():
+        with open(path, 'rb') as fh:
+            data = fh.read()
+        # A unique name per request, as separate real users would send, so the
+        # server never has two uploads competing for one path.
+        stem, ext = os.path.splitext(os.path.basename(path))
+        filename = f"{stem}_{uuid.uuid4().hex[:12]}{ext}"
+        parts.append(
+            f'--{boundary}\r\nContent-Disposition: form-data; name="{name}"; filename="{filename}"\r\n'
+            f'Content-Type: application/octet-stream\r\n\r\n'.encode() + data + b'\r\n'
+        )
+    parts.append(f'--{boundary}--\r\n'.encode())
+    return b''.join(parts), f'multipart/form-data; boundary={boundary}'
+
+
+class Client:
+    """One virtual user with its own session cookie."""
+
+    def __init__(self, base_url: str, fixtures: Dict[str, str], timeout: float):
+        self.base_url = base_url
+        self.fixtures = fixtures
+        self.timeout = timeout
+        self.opener = urllib.request.build_opener(
+            urllib.request.HTTPCookieProcessor(http.cookiejar.CookieJar())
+        )
+
+    def _send(self, path: str, body: bytes, content_type: str) -> int:
+        req = urllib.request.Request(self.base_url + path, data=body, method='POST',
+                                     headers={'Content-Type': content_type})
+        try:
+            with self.opener.open(req, timeout=self.timeout) as resp:
+                resp.read()
+                return resp.status
+        except urllib.error.HTTPError as e:
+            e.read()
+            return e.code
+
+    def login(self) -> int:
+        return self._send('/api/login', json.dumps(TEACHER).encode(), 'application/json')
+
+    def api_upload(self) -> int:
+        body, ctype = _multipart({'subjectName': 'DWM'}, {'pdfUpload': self.fixtures['pdf']})
+        return self._send('/api/upload', body, ctype)
+
+    def api_process(self) -> int:
+        body, ctype = _multipart({}, {'file': self.fixtures['png']})
+        return self._send('/api/process', body, ctype)
+
+    def upload(self) -> int:
+        body, ctype = _multipart({}, {'file': self.fixtures['pdf']})
+        return self._send('/upload', body, ctype)
+
+
+# ---------- Server ----------
+
+def start_server(args, fixtures: Dict[str, str], work_dir: str) -> subprocess.Popen:
+    env = dict(os.environ)
+    env.update({
+        'GEMINI_STUB_DIR': fixtures['stub_dir'],
+        'UPLOAD_FOLDER': os.path.join(work_dir, 'uploads'),
+        'SECRET_KEY': 'loadtest',
+        # Every request replays the same sheet, so cross-request caches would turn
+        # all but the first request per worker into cache hits. Off unless asked for.
+        'PIPELINE_CACHE_SIZE': str(args.pipeline_cache_size),
+        'LAYOUT_CACHE': '1' if args.layout_cache else '0',
+    })
+    cmd = [
+        sys.executable, '-m', 'gunicorn', 'app:app',
+        '--bind', f'127.0.0.1:{args.port}',
+        '--workers', str(args.workers),
+        '--worker-class', args.worker_class,
+        '--threads', str(args.threads),
+        '--timeout', str(int(args.timeout)),
+    ]
+    proc = subprocess.Popen(cmd, cwd=BASE_DIR, env=env)
+    deadline = time.time() + args.startup_timeout
+    while time.time() < deadline:
+        if proc.poll() is not None:
+            raise RuntimeError(f'gunicorn exited with code {proc.returncode}')
+        try:
+            urllib.request.urlopen(f'http://127.0.0.1:{args.port}/login', timeout=2).read()
+            return proc
+        except Exception:
+            time.sleep(0.5)
+    proc.terminate()
+    raise RuntimeError('gunicorn did not become ready in time')
+
+
+def _worker_pids(master_pid: int) -> List[int]:
+    pids = []
+    for entry in os.listdir('/proc'):
+        if not entry.isdigit():
+            continue
+        try:
+            with open(f'/proc/{entry}/stat', 'r') as fh:
+                fields = fh.read().rsplit(')', 1)[1].split()
+            if int(fields[1]) == master_pid:
+                pids.append(int(entry))
+        except (OSError, IndexError, ValueError):
+            continue
+    return pids
+
+
+def _rss_mb(pid: int) -> float | None:
+    try:
+        with open(f'/proc/{pid}/status', 'r') as fh:
+            for line in fh:
+                if line.startswith('VmRSS:'):
+                    return round(int(line.split()[1]) / 1024, 1)
+    except OSError:
+        return None
+    return None
+
+
+class RssSampler(threading.Thread):
+    """Periodically record the RSS of every gunicorn worker (Linux /proc only)."""
+
+    def __init__(self, master_pid: int, interval: float = 1.0):
+        super().__init__(daemon=True)
+        self.master_pid = master_pid
+        self.interval = interval
+        self.samples: Dict[int, List[float]] = {}
+        self._stop_event = threading.Event()
+
+    def run(self):
+        while not self._stop_event.is_set():
+            for pid in _worker_pids(self.master_pid):
+                rss = _rss_mb(pid)
+                if rss is not None:
+                    self.samples.setdefault(pid, []).append(rss)
+            self._stop_event.wait(self.interval)
+
+    def stop(self):
+        self._stop_event.set()
+
+    def summary(self) -> Dict[str, Any]:
+        return {
+            str(pid): {'rss_max_mb': max(vals), 'rss_last_mb': vals[-1], 'samples': len(vals)}
+            for pid, vals in self.samples.items()
+        }
+
+
+# ---------- Run ----------
+
+def _percentile(values: List[float], pct: float) -> float | None:
+    if not values:
+        return None
+    ordered = sorted(values)
+    k = min(len(ordered) - 1, max(0, int(round(pct / 100 * (len(ordered) - 1)))))
+    return round(ordered[k], 1)
+
+
+def parse_mix(spec: str) -> Dict[str, float]:
+    mix = {}
+    for part in spec.split(','):
+        name, _, weight = part.partition('=')
+        name = name.strip()
+        if name not in ('login', 'api_upload', 'api_process', 'upload'):
+            raise ValueError(f'Unknown endpoint in mix: {name}')
+        mix[name] = float(weight or 1)
+    return mix
+
+
+def _status_counts(rows: List[tuple]) -> Dict[str, int]:
+    # Status 0 means the request failed before any HTTP response (timeout, reset).
+    counts: Dict[str, int] = {}
+    for r in rows:
+        counts[str(r[1])] = counts.get(str(r[1]), 0) + 1
+    return dict(sorted(counts.items()))
+
+
+def run_load(args, fixtures: Dict[str, str]) -> Dict[str, Any]:
+    base_url = f'http://127.0.0.1:{args.port}'
+    mix = parse_mix(args.mix)
+    names, weights = list(mix), list(mix.values())
+    records: List[tuple] = []
+    lock = threading.Lock()
+    stop_at = time.time() + args.duration
+
+    def user(seed: int):
+        rnd = random.Random(seed)
+        client = Client(base_url, fixtures, args.timeout)
+        client.login()
+        while time.time() < stop_at:
+            name = rnd.choices(names, weights)[0]
+            start = time.perf_counter()
+            try:
+                status = getattr(client, name)()
+            except Exception:
+                status = 0
+            elapsed = (time.perf_counter() - start) * 1000
+            with lock:
+                records.append((name, status, elapsed))
+
+    started = time.time()
+    threads = [threading.Thread(target=user, args=(i,), daemon=True) for i in range(args.concurrency)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    wall = time.time() - started
+
+    endpoints: Dict[str, Any] = {}
+    for name in names:
+        rows = [r for r in records if r[0] == name]
+        latencies = [r[2] for r in rows]
+        errors = sum(1 for r in rows if not 200 <= r[1] < 300)
+        endpoints[name] = {
+            'requests': len(rows),
+            'errors': errors,
+            'error_rate': round(errors / len(rows), 4) if rows else 0.0,
+            'status_codes': _status_counts(rows),
+            'p50_ms': _percentile(latencies, 50),
+            'p95_ms': _percentile(latencies, 95),
+            'p99_ms': _percentile(latencies, 99),
+        }
+    latencies = [r[2] for r in records]
+    errors = sum(1 for r in records if not 200 <= r[1] < 300)
+    overall = {
+        'requests': len(records),
+        'errors': errors,
+        'error_rate': round(errors / len(records), 4) if records else 0.0,
+        'status_codes': _status_counts(records),
+        'throughput_rps': round(len(records) / wall, 2) if wall else 0.0,
+        'p50_ms': _percentile(latencies, 50),
+        'p95_ms': _percentile(latencies, 95),
+        'p99_ms': _percentile(latencies, 99),
+        'wall_s': round(wall, 1),
+    }
+    return {'overall': overall, 'endpoints': endpoints}
+
+
+def _git_revision() -> str | None:
+    try:
+        out = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=BASE_DIR,
+                             capture_output=True, text=True, timeout=10)
+        return out.stdout.strip() or None
+    except Exception:
+        return None
+
+
+def compare(current: Dict[str, Any], previous_path: str) -> None:
+    with open(previous_path, 'r', encoding='utf-8') as fh:
+        previous = json.load(fh)
+    print(f"\nCompared with {previous_path} (build {previous.get('build')}):")
+    for key in CACHE_SETTINGS:
+        old, new = previous.get('config', {}).get(key), current['config'].get(key)
+        if old != new:
+            print(f"  note: {key} differs ({old} -> {new}); results are not like for like")
+    for key in ('throughput_rps', 'p50_ms', 'p95_ms', 'p99_ms', 'error_rate'):
+        old, new = previous['overall'].get(key), current['overall'].get(key)
+        if old is None or new is None:
+            continue
+        change = f"{(new - old) / old * 100:+.1f}%" if old else 'n/a'
+        print(f"  {key:>15}: {old} -> {new} ({change})")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--worker-class', default='sync', choices=['sync', 'gthread', 'gevent'])
+    parser.add_argument('--workers', type=int, default=2)
+    parser.add_argument('--threads', type=int, default=1)
+    parser.add_argument('--concurrency', type=int, default=4, help='number of virtual users')
+    parser.add_argument('--duration', type=float, default=30.0, help='seconds of traffic')
+    parser.add_argument('--mix', default=DEFAULT_MIX, help='endpoint weights, e.g. login=1,api_upload=3')
+    parser.add_argument('--students', type=int, default=30)
+    parser.add_argument('--dates', type=int, default=8)
+    parser.add_argument('--port', type=int, default=5055)
+    parser.add_argument('--timeout', type=float, default=300.0, help='per-request and worker timeout (s)')
+    parser.add_argument('--startup-timeout', type=float, default=60.0)
+    parser.add_argument('--pipeline-cache-size', type=int, default=0,
+                        help='PIPELINE_CACHE_SIZE for the server (0 = no stage output cache)')
+    parser.add_argument('--layout-cache', action='store_true', help='enable the per-subject layout cache')
+    parser.add_argument('--label', default='', help='name added to the results file')
+    parser.add_argument('--compare', help='previous results JSON to compare against')
+    args = parser.parse_args()
+
+    work_dir = tempfile.mkdtemp(prefix='loadtest_')
+    try:
+        fixtures = prepare_fixtures(work_dir, args.students, args.dates)
+        server = start_server(args, fixtures, work_dir)
+        sampler = RssSampler(server.pid)
+        sampler.start()
+        try:
+            report = run_load(args, fixtures)
+        finally:
+            sampler.stop()
+            server.terminate()
+            server.wait(timeout=30)
+
+        report.update({
+            'build': _git_revision(),
+            'timestamp': datetime.now().isoformat(timespec='seconds'),
+            'config': {k: v for k, v in vars(args).items() if k not in ('compare',)},
+            'workers': sampler.summary(),
+        })
+        os.makedirs(RESULTS_FOLDER, exist_ok=True)
+        label = f"_{args.label}" if args.label else ''
+        out_path = os.path.join(
+            RESULTS_FOLDER,
+            f"{datetime.now().strftime('%Y%m%d_%H%M%S')}_{args.worker_class}{label}.json",
+        )
+        with open(out_path, 'w', encoding='utf-8') as fh:
+            json.dump(report, fh, indent=2)
+
+        print(json.dumps(report['overall'], indent=2))
+        for name, stats in report['endpoints'].items():
+            print(f"  {name:>12}: {stats}")
+        for pid, stats in report['workers'].items():
+            print(f"  worker {pid}: {stats}")
+        print(f"Saved results to {out_path}")
+        if args.compare:
+            compare(report, args.compare)
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,195 @@
+import os
+import threading
+import tracemalloc
+from contextlib import contextmanager
+from typing import Dict, Any
+
+from dotenv import load_dotenv, find_dotenv
+
+# ---------- Env ----------
+dotenv_path = os.path.join(os.path.dirname(__file__), '.env')
+if not os.path.exists(dotenv_path):
+    dotenv_path = find_dotenv()
+if dotenv_path:
+    load_dotenv(dotenv_path)
+
+# Largest raster (in pixels) the pipeline will hold for a single page. A 300-DPI
+# A3 page is ~17.4 MP; the default keeps a page around A4 at 300 DPI.
+MAX_PAGE_PIXELS = int(os.getenv('MAX_PAGE_PIXELS', str(9_000_000)))
+# Rough peak bytes per page pixel across the pipeline (RGB pixmap, grayscale,
+# binarized copy, morphology buffers, crops).
+BYTES_PER_PIXEL = int(os.getenv('BYTES_PER_PIXEL', '8'))
+# Ceiling on a worker's projected memory: its RSS when it last went idle plus
+# the estimates of all in-flight jobs, the new one included.
+WORKER_MEMORY_BUDGET_MB = int(os.getenv('WORKER_MEMORY_BUDGET_MB', '1536'))
+# Recycle a worker after this many jobs (0 disables) or once its RSS passes the ceiling.
+WORKER_MAX_JOBS = int(os.getenv('WORKER_MAX_JOBS', '200'))
+WORKER_RSS_CEILING_MB = int(os.getenv('WORKER_RSS_CEILING_MB', '2048'))
+# Opt-in tracemalloc snapshots for leak hunting (adds allocation overhead).
+MEMORY_DEBUG = os.getenv('MEMORY_DEBUG', '0') in ('1', 'true', 'True')
+
+_lock = threading.Lock()
+_reserved_bytes = 0
+_idle_rss_bytes = 0
+_in_flight = 0
+_jobs_done = 0
+_last_snapshot = None
+
+if MEMORY_DEBUG and not tracemalloc.is_tracing():
+    tracemalloc.start(25)
+
+
+# ---------- Measurements ----------
+
+def current_rss_bytes() -> int:
+    """Resident set size of this process (VmRSS on Linux, peak RSS elsewhere)."""
+    try:
+        with open('/proc/self/status', 'r') as fh:
+            for line in fh:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    try:
+        import resource
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+    except Exception:
+        return 0
+
+
+def capped_dpi(width_pt: float, height_pt: float, dpi: int) -> int:
+    """Lower `dpi` so a page of the given size (in points) stays under MAX_PAGE_PIXELS."""
+    pixels = (width_pt / 72.0 * dpi) * (height_pt / 72.0 * dpi)
+    if pixels <= MAX_PAGE_PIXELS:
+        return dpi
+    return max(72, int(dpi * (MAX_PAGE_PIXELS / pixels) ** 0.5))
+
+
+def capped_size(width: int, height: int) -> tuple:
+    """(width, height) scaled down, keeping aspect, to fit under MAX_PAGE_PIXELS."""
+    pixels = width * height
+    if pixels <= MAX_PAGE_PIXELS:
+        return width, height
+    scale = (MAX_PAGE_PIXELS / pixels) ** 0.5
+    return max(1, int(width * scale)), max(1, int(height * scale))
+
+
+def decode_reduction(width: int, height: int) -> int:
+    """Smallest decoder downscale (1, 2, 4 or 8) that brings an image under MAX_PAGE_PIXELS."""
+    for factor in (1, 2, 4):
+        if (width // factor) * (height // factor) <= MAX_PAGE_PIXELS:
+            return factor
+    return 8
+
+
+def estimate_job_bytes(path: str) -> int:
+    """Upper estimate of the peak memory a single upload will need."""
+    ext = os.path.splitext(path)[1].lower()
+    pixels = MAX_PAGE_PIXELS
+    if ext != '.pdf':
+        try:
+            from PIL import Image
+            with Image.open(path) as im:
+                w, h = capped_size(*im.size)
+                pixels = w * h
+        except Exception:
+            pass
+    return pixels * BYTES_PER_PIXEL
+
+
+# ---------- Admission and recycling ----------
+
+@contextmanager
+def job(estimate_bytes: int):
+    """Admit a job against the worker's memory budget.
+
+    Yields None when admitted, or an error dict when the job would push the
+    worker past WORKER_MEMORY_BUDGET_MB. RSS is sampled only while the worker
+    is idle, so memory already held by in-flight jobs is not counted twice.
+    A worker with nothing in flight always admits, so an oversized job still
+    runs on an otherwise idle worker. Sync gunicorn workers serve one request
+    at a time and therefore always admit; the budget only applies to threaded
+    (GUNICORN_THREADS > 1) or async workers.
+    """
+    global _reserved_bytes, _idle_rss_bytes, _in_flight, _jobs_done
+    budget = WORKER_MEMORY_BUDGET_MB * 1024 * 1024
+    with _lock:
+        if _in_flight == 0:
+            _idle_rss_bytes = current_rss_bytes()
+            admitted = True
+        else:
+            admitted = _idle_rss_bytes + _reserved_bytes + estimate_bytes <= budget
+        if admitted:
+            _reserved_bytes += estimate_bytes
+            _in_flight += 1
+    if not admitted:
+        yield {"error": "Server is busy processing other sheets. Please retry shortly."}
+        return
+    try:
+        yield None
+    finally:
+        with _lock:
+            _reserved_bytes -= estimate_bytes
+            _in_flight -= 1
+            _jobs_done += 1
+
+
+def should_recycle() -> bool:
+    """True once this worker has done WORKER_MAX_JOBS jobs or its RSS passed the ceiling."""
+    if WORKER_MAX_JOBS and _jobs_done >= WORKER_MAX_JOBS:
+        return True
+    return current_rss_bytes() > WORKER_RSS_CEILING_MB * 1024 * 1024
+
+
+def status() -> Dict[str, Any]:
+    return {
+        'rss_mb': round(current_rss_bytes() / (1024 * 1024), 1),
+        'idle_rss_mb': round(_idle_rss_bytes / (1024 * 1024), 1),
+        'reserved_mb': round(_reserved_bytes / (1024 * 1024), 1),
+        'in_flight': _in_flight,
+        'jobs_done': _jobs_done,
+        'budget_mb': WORKER_MEMORY_BUDGET_MB,
+        'rss_ceiling_mb': WORKER_RSS_CEILING_MB,
+        'max_jobs': WORKER_MAX_JOBS,
+    }
+
+
+# ---------- tracemalloc snapshots ----------
+
+def snapshot_report(limit: int = 25) -> Dict[str, Any]:
+    """Top allocation sites now, plus growth since the previous call."""
+    global _last_snapshot
+    if not tracemalloc.is_tracing():
+        return {"error": "Memory tracing is disabled. Set MEMORY_DEBUG=1 and restart."}
+
+    snapshot = tracemalloc.take_snapshot().filter_traces((
+        tracemalloc.Filter(False, tracemalloc.__file__),
+        tracemalloc.Filter(False, '<frozen importlib._bootstrap>'),
+    ))
+    current, peak = tracemalloc.get_traced_memory()
+
+    def fmt(stat):
+        frame = stat.traceback[0]
+        return {
+            'location': f"{frame.filename}:{frame.lineno}",
+            'size_kb': round(stat.size / 1024, 1),
+            'count': stat.count,
+        }
+
+    report = {
+        'traced_mb': round(current / (1024 * 1024), 1),
+        'peak_mb': round(peak / (1024 * 1024), 1),
+        'top': [fmt(s) for s in snapshot.statistics('lineno')[:limit]],
+    }
+    if _last_snapshot is not None:
+        report['growth'] = [
+            {
+                'location': f"{d.traceback[0].filename}:{d.traceback[0].lineno}",
+                'size_diff_kb': round(d.size_diff / 1024, 1),
+                'count_diff': d.count_diff,
+            }
+            for d in snapshot.compare_to(_last_snapshot, 'lineno')[:limit]
+        ]
+    _last_snapshot = snapshot
+    report['worker'] = status()
+    return report
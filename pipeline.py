@@ -0,0 +1,178 @@
+import os
+import time
+import threading
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from typing import List, Dict, Any, Callable
+
+from dotenv import load_dotenv, find_dotenv
+
+from deadlines import Deadline, DeadlineExceeded
+
+# ---------- Env ----------
+dotenv_path = os.path.join(os.path.dirname(__file__), '.env')
+if not os.path.exists(dotenv_path):
+    dotenv_path = find_dotenv()
+if dotenv_path:
+    load_dotenv(dotenv_path)
+
+# Entries kept per worker in the stage output cache (0 disables caching).
+PIPELINE_CACHE_SIZE = int(os.getenv('PIPELINE_CACHE_SIZE', '32'))
+
+
+@dataclass
+class RunContext:
+    """State shared by every stage of one pipeline run."""
+    path: str
+    subject: str | None = None
+    deadline: Deadline | None = None
+    # Filled in by the ingest stage; used to key cached stage outputs.
+    content_hash: str | None = None
+    timings_ms: Dict[str, float] = field(default_factory=dict)
+    backends_used: Dict[str, str] = field(default_factory=dict)
+    cache_hits: List[str] = field(default_factory=list)
+
+
+@dataclass
+class Stage:
+    """A declared pipeline stage and the value types it consumes and produces.
+
+    `default_backend` is either a backend name or a callable choosing one from
+    the stage input, so e.g. rasterize can pick 'pdf' or 'photo' per upload.
+    """
+    name: str
+    input_type: type | tuple
+    output_type: type | tuple
+    default_backend: str | Callable[[Any, RunContext], str]
+    backends: Dict[str, Callable[[Any, RunContext], Any]] = field(default_factory=dict)
+    cache_keys: Dict[str, Callable[[RunContext], Any]] = field(default_factory=dict)
+
+
+class Pipeline:
+    """Runs values through an ordered list of stages with pluggable backends.
+
+    A stage backend is `fn(value, ctx)` returning the stage's output type, or
+    an error dict (`{"error": ...}`), which stops the run and is returned as is.
+    Backends registered with a `cache_key(ctx)` have their outputs kept in a
+    small per-process LRU; a run starts from the latest cached stage it can.
+    Hooks are called after every stage as `hook(stage, backend, elapsed_ms, ctx)`.
+    The deadline is checked before each stage, except that a value marked
+    `partial` (cut short by the deadline) still runs the remaining stages.
+    """
+
+    def __init__(self, stages: List[Stage], cache_size: int = PIPELINE_CACHE_SIZE):
+        self.stages = stages
+        self._by_name = {s.name: s for s in stages}
+        self._hooks: List[Callable[[str, str, float, RunContext], None]] = []
+        self._cache: OrderedDict = OrderedDict()
+        self._cache_size = cache_size
+        self._lock = threading.Lock()
+
+    def backend(self, stage: str, name: str, cache_key: Callable[[RunContext], Any] | None = None):
+        """Decorator registering `fn(value, ctx)` as backend `name` of `stage`."""
+        def register(fn):
+            self._by_name[stage].backends[name] = fn
+            if cache_key is not None:
+                self._by_name[stage].cache_keys[name] = cache_key
+            return fn
+        return register
+
+    def add_hook(self, hook: Callable[[str, str, float, RunContext], None]) -> None:
+        self._hooks.append(hook)
+
+    # ---------- cache ----------
+
+    def _cache_get(self, key):
+        with self._lock:
+            if key in self._cache:
+                self._cache.move_to_end(key)
+                return True, self._cache[key]
+        return False, None
+
+    def _cache_put(self, key, value) -> None:
+        if self._cache_size <= 0:
+            return
+        with self._lock:
+            self._cache[key] = value
+            self._cache.move_to_end(key)
+            while len(self._cache) > self._cache_size:
+                self._cache.popitem(last=False)
+
+    def _cache_key(self, stage: Stage, backend: str, ctx: RunContext):
+        key_fn = stage.cache_keys.get(backend)
+        if key_fn is None:
+            return None
+        key = key_fn(ctx)
+        return None if key is None else (stage.name, backend, key)
+
+    # ---------- run ----------
+
+    def _choose(self, stage: Stage, value, ctx: RunContext, overrides: Dict[str, str]) -> str:
+        if stage.name in overrides:
+            return overrides[stage.name]
+        if callable(stage.default_backend):
+            return stage.default_backend(value, ctx)
+        return stage.default_backend
+
+    def run(self, value, ctx: RunContext, start: str | None = None, stop: str | None = None,
+            backends: Dict[str, str] | None = None):
+        """Run `value` through the stages from `start` to `stop` (inclusive)."""
+        overrides = backends or {}
+        names = [s.name for s in self.stages]
+        first = names.index(start) if start else 0
+        last = names.index(stop) if stop else len(names) - 1
+        selected = self.stages[first:last + 1]
+
+        # Jump ahead to the latest stage whose output is already cached. Only
+        # stages with a fixed (non input-dependent) backend can be looked up early.
+        for i in range(len(selected) - 1, 0, -1):
+            stage = selected[i]
+            if stage.name not in overrides and callable(stage.default_backend):
+                continue
+            backend = overrides.get(stage.name, stage.default_backend)
+            key = self._cache_key(stage, backend, ctx)
+            if key is None:
+                continue
+            hit, cached = self._cache_get(key)
+            if hit:
+                ctx.cache_hits.append(stage.name)
+                ctx.backends_used[stage.name] = backend
+                value = cached
+                selected = selected[i + 1:]
+                break
+
+        for stage in selected:
+            if ctx.deadline is not None:
+                if getattr(value, 'partial', None):
+                    # A value already cut short by the deadline is finished with
+                    # what it has; only a disconnect still stops the run.
+                    if ctx.deadline.cancelled():
+                        raise DeadlineExceeded(stage.name, cancelled=True)
+                else:
+                    ctx.deadline.check(stage.name)
+            if not isinstance(value, stage.input_type):
+                raise TypeError(f"Stage '{stage.name}' expects {stage.input_type}, got {type(value).__name__}")
+
+            backend = self._choose(stage, value, ctx, overrides)
+            fn = stage.backends.get(backend)
+            if fn is None:
+                raise KeyError(f"No backend '{backend}' registered for stage '{stage.name}'")
+
+            started = time.perf_counter()
+            out = fn(value, ctx)
+            elapsed = round((time.perf_counter() - started) * 1000, 1)
+            ctx.timings_ms[stage.name] = round(ctx.timings_ms.get(stage.name, 0.0) + elapsed, 1)
+            ctx.backends_used[stage.name] = backend
+            for hook in self._hooks:
+                hook(stage.name, backend, elapsed, ctx)
+
+            if isinstance(out, dict) and out.get('error'):
+                return out
+            if not isinstance(out, stage.output_type):
+                raise TypeError(f"Stage '{stage.name}' backend '{backend}' returned {type(out).__name__}")
+
+            key = self._cache_key(stage, backend, ctx)
+            if key is not None and getattr(out, 'cacheable', True):
+                self._cache_put(key, out)
+            value = out
+        return value
@@ -1,5 +1,10 @@
-import osimport os
+import os
 import json
+import time
+import hashlib
+import threading
+from dataclasses import dataclass, field
+from concurrent.futures import Future, TimeoutError as FutureTimeout
 from typing import List, Dict, Any
 
 import pandas as pd
@@ -15,6 +20,11 @@ import easyocr
 # Gemini
 import google.generativeai as genai
 
+import layout_cache
+import memory_governor
+from deadlines import Deadline, DeadlineExceeded, timeout_error
+from pipeline import Pipeline, Stage, RunContext
+
 # ---------- Env ----------
 dotenv_path = os.path.join(os.path.dirname(__file__), '.env')
 if not os.path.exists(dotenv_path):
@@ -36,6 +46,37 @@ def _configure_gemini_or_error():
 
 # ---------- Gemini helpers ----------
 
+GEMINI_MODEL = os.getenv('GEMINI_MODEL', 'gemini-1.5-flash-latest')
+
+
+def _generate_content(kind: str, parts: List[Any], deadline: Deadline | None = None) -> str | Dict[str, Any]:
+    """Send one multimodal request to Gemini and return the response text.
+
+    When GEMINI_STUB_DIR is set, the canned response `<GEMINI_STUB_DIR>/<kind>.json`
+    is returned instead, so the pipeline can run locally without an API key.
+    With a deadline, the request is given only the time the caller has left.
+    """
+    if deadline is not None:
+        deadline.check('gemini')
+    stub_dir = os.getenv('GEMINI_STUB_DIR')
+    if stub_dir:
+        stub_path = os.path.join(stub_dir, f"{kind}.json")
+        if not os.path.exists(stub_path):
+            return {"error": f"No Gemini stub response at {stub_path}."}
+        with open(stub_path, 'r', encoding='utf-8') as fh:
+            return fh.read()
+
+    err = _configure_gemini_or_error()
+    if err:
+        return err
+    model = genai.GenerativeModel(GEMINI_MODEL)
+    if deadline is not None:
+        response = model.generate_content(parts, request_options={'timeout': max(1.0, deadline.remaining())})
+    else:
+        response = model.generate_content(parts)
+    return response.text
+
+
 def create_gemini_prompt() -> str:
     return (
         """
@@ -67,6 +108,159 @@ def _parse_gemini_json(text: str) -> Dict[str, Any]:
     return json.loads(cleaned)
 
 
+# ---------- Multi-sheet batching ----------
+
+# Sheets waiting for Gemini are coalesced for up to GEMINI_BATCH_WINDOW_MS or
+# until GEMINI_BATCH_MAX_SHEETS are pending, then sent as one request.
+# 'auto' batches only in workers that serve requests concurrently (threads or
+# green threads, flagged by gunicorn.conf.py); a sync worker's sheet would
+# always wait out the window alone.
+GEMINI_BATCH = os.getenv('GEMINI_BATCH', 'auto')
+GEMINI_BATCH_WINDOW_MS = int(os.getenv('GEMINI_BATCH_WINDOW_MS', '150'))
+GEMINI_BATCH_MAX_SHEETS = int(os.getenv('GEMINI_BATCH_MAX_SHEETS', '4'))
+
+
+def create_batch_prompt(count: int) -> str:
+    return (
+        f"""
+        You are an expert OCR system specializing in extracting structured data from handwritten attendance sheets.
+        You are given {count} separate attendance sheet images, each preceded by a label "SHEET <n>" (n = 0 to {count - 1}).
+        Analyze each sheet independently and return a single, clean JSON object. Do not include any explanatory text before or after the JSON.
+
+        The JSON object must have one key, "sheets": a list with exactly one entry per sheet, each containing:
+            - "sheet": the sheet number (integer).
+            - "dates": list of lecture date strings from that sheet's column headers, left to right.
+            - "students": list of objects with "roll_no", "student_id", "name" (strings) and "attendance"
+              (list of "Present"/"Absent", one per date).
+
+        INTERPRETATION RULES:
+        - A signature, a 'P', a tick mark, or any significant marking in an attendance cell means "Present".
+        - An 'A', 'AB', or a blank/empty cell means "Absent".
+        - Ignore any rows that do not contain a student's name.
+        - Never mix rows or dates between sheets.
+        """
+    )
+
+
+def _split_batch_response(text: str, count: int) -> List[Dict[str, Any]]:
+    """Split a combined batch answer into one validated result (or error dict) per sheet."""
+    try:
+        data = _parse_gemini_json(text)
+    except ValueError as e:
+        return [{"error": f"Gemini returned invalid JSON for the sheet batch: {e}"}] * count
+
+    per_sheet: List[Dict[str, Any] | None] = [None] * count
+    for entry in data.get('sheets', []) if isinstance(data, dict) else []:
+        if not isinstance(entry, dict):
+            continue
+        try:
+            index = int(entry.get('sheet'))
+        except (TypeError, ValueError):
+            continue
+        if not 0 <= index < count or per_sheet[index] is not None:
+            continue
+        dates = entry.get('dates')
+        students = entry.get('students')
+        if not isinstance(dates, list) or not isinstance(students, list) \
+                or not all(isinstance(st, dict) for st in students):
+            per_sheet[index] = {"error": f"Gemini returned a malformed result for sheet {index}."}
+            continue
+        per_sheet[index] = {'dates': dates, 'students': students}
+    return [
+        r if r is not None else {"error": f"Gemini returned no result for sheet {i}."}
+        for i, r in enumerate(per_sheet)
+    ]
+
+
+def _extract_sheets_with_gemini(images: List[Image.Image], deadline: Deadline | None = None) -> List[Dict[str, Any]]:
+    """Extract several sheets with one Gemini request per GEMINI_BATCH_MAX_SHEETS images."""
+    results: List[Dict[str, Any]] = []
+    for start in range(0, len(images), max(1, GEMINI_BATCH_MAX_SHEETS)):
+        chunk = images[start:start + max(1, GEMINI_BATCH_MAX_SHEETS)]
+        if len(chunk) == 1:
+            text = _generate_content('sheet', [create_gemini_prompt(), chunk[0]], deadline)
+            if isinstance(text, dict):
+                results.append(text)
+            else:
+                try:
+                    results.append(_parse_gemini_json(text))
+                except ValueError as e:
+                    results.append({"error": f"Gemini returned invalid JSON: {e}"})
+            continue
+
+        parts: List[Any] = [create_batch_prompt(len(chunk))]
+        for i, image in enumerate(chunk):
+            parts.extend([f"SHEET {i}", image])
+        text = _generate_content('batch', parts, deadline)
+        if isinstance(text, dict):
+            results.extend([text] * len(chunk))
+        else:
+            results.extend(_split_batch_response(text, len(chunk)))
+    return results
+
+
+def _batching_enabled() -> bool:
+    if GEMINI_BATCH == 'auto':
+        return os.getenv('WORKER_CONCURRENT', '0') == '1'
+    return GEMINI_BATCH in ('1', 'true', 'True')
+
+
+def _batch_deadline(deadlines: List[Deadline | None]) -> Deadline | None:
+    """Deadline for a shared request: the latest of its members', with no disconnect probe.
+
+    Each waiter enforces its own deadline, so one member timing out or
+    disconnecting must not cut the request short for the others.
+    """
+    if not deadlines or any(d is None for d in deadlines):
+        return None
+    return Deadline(max(d.remaining() for d in deadlines))
+
+
+class _SheetBatcher:
+    """Coalesces concurrent single-sheet Gemini requests in this worker into batches.
+
+    The first request to arrive waits out the window (or until the batch is
+    full), sends everything pending under the latest member deadline, and
+    hands each waiter its own result; waiters give up at their own deadline.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._pending: List[tuple] = []
+        self._full = threading.Event()
+
+    def submit(self, image: Image.Image, deadline: Deadline | None = None) -> Dict[str, Any]:
+        future: Future = Future()
+        with self._lock:
+            self._pending.append((image, deadline, future))
+            leader = len(self._pending) == 1
+            if len(self._pending) >= GEMINI_BATCH_MAX_SHEETS:
+                self._full.set()
+
+        if leader:
+            self._full.wait(GEMINI_BATCH_WINDOW_MS / 1000.0)
+            with self._lock:
+                batch, self._pending = self._pending, []
+                self._full.clear()
+            try:
+                answers = _extract_sheets_with_gemini([img for img, _, _ in batch],
+                                                      _batch_deadline([d for _, d, _ in batch]))
+                for (_, _, fut), answer in zip(batch, answers):
+                    fut.set_result(answer)
+            except Exception as e:
+                for _, _, fut in batch:
+                    if not fut.done():
+                        fut.set_exception(e)
+
+        try:
+            return future.result(timeout=deadline.remaining() if deadline is not None else None)
+        except FutureTimeout:
+            raise DeadlineExceeded('gemini')
+
+
+_sheet_batcher = _SheetBatcher()
+
+
 def _normalize_records_to_df(dates: List[str], students: List[Dict[str, Any]]) -> pd.DataFrame:
     processed: List[Dict[str, Any]] = []
     for record in students:
@@ -108,42 +302,142 @@ def _build_reports_from_dataframe(df: pd.DataFrame, dates: List[str] | None = No
     is_dup = df.duplicated(subset=['Roll No'], keep=False) & (df['Roll No'] != '')
     df['Anomaly'] = np.where(is_dup, 'Duplicate Roll No', '')
 
+    # Expand the frame once; the filtered lists share the same row dicts.
+    full_report = df.to_dict(orient='records')
     return {
         'dates': dates,
-        'full_report': df.to_dict(orient='records'),
-        'defaulters': df[df['Status'] == 'Defaulter'].to_dict(orient='records'),
-        'anomalies': df[df['Anomaly'] != ''].to_dict(orient='records')
+        'full_report': full_report,
+        'defaulters': [row for row in full_report if row['Status'] == 'Defaulter'],
+        'anomalies': [row for row in full_report if row['Anomaly'] != '']
     }
 
 
-# ---------- PDF OCR (EasyOCR + OpenCV + PyMuPDF) ----------
+# ---------- OCR (EasyOCR + OpenCV) ----------
 
-def convert_pdf_page_to_image(pdf_path: str, page_number: int = 0, dpi: int = 300):
-    try:
-        doc = fitz.open(pdf_path)
-        page = doc.load_page(page_number)
-        pix = page.get_pixmap(dpi=dpi)
-        out_path = os.path.splitext(pdf_path)[0] + f"_page{page_number+1}.png"
-        pix.save(out_path)
-        doc.close()
-        return out_path
-    except Exception as e:
-        return {"error": f"Failed to convert PDF to image: {e}"}
+# Recognition profiles passed straight to `reader.readtext`. Constrained columns
+# use an allowlist and the greedy decoder; only free-text cells (names and the
+# leading header labels) pay for beam search.
+OCR_PROFILES: Dict[str, Dict[str, Any]] = {
+    'text': {'decoder': 'beamsearch', 'beamWidth': 5},
+    'digits': {'allowlist': '0123456789', 'decoder': 'greedy'},
+    # Lecture-date headers may spell out months or weekdays ('12-Aug', 'Mon').
+    'date': {'decoder': 'greedy'},
+    'mark': {'decoder': 'greedy'},
+}
 
+# Profile used for the data cells of each column kind.
+COLUMN_PROFILES = {
+    'roll': 'digits',
+    'id': 'digits',
+    'name': 'text',
+    'date': 'mark',
+}
 
-def process_pdf_with_easyocr(pdf_path: str) -> pd.DataFrame | Dict[str, Any]:
-    img_path = convert_pdf_page_to_image(pdf_path)
-    if isinstance(img_path, dict):
-        return img_path
+# Header cells are read as free text up to the first date-like label, so the
+# 'Roll No' / 'Name' labels can be recognized; that cell and the rest are
+# lecture dates.
+_DATE_WORDS = {
+    'jan', 'feb', 'mar', 'apr', 'may', 'jun', 'jul', 'aug', 'sep', 'sept', 'oct', 'nov', 'dec',
+    'january', 'february', 'march', 'april', 'june', 'july', 'august', 'september',
+    'october', 'november', 'december',
+    'mon', 'tue', 'tues', 'wed', 'thu', 'thur', 'thurs', 'fri', 'sat', 'sun',
+    'monday', 'tuesday', 'wednesday', 'thursday', 'friday', 'saturday', 'sunday',
+}
 
-    img = cv2.imread(img_path, cv2.IMREAD_GRAYSCALE)
-    if img is None:
-        return {"error": "Could not read the converted image file."}
+# First word of the header label of a serial-number column ('Sr No', 'S.No', ...).
+_SERIAL_LABELS = ('sr', 'sl', 's', 'sno', 'srno', 'slno', 'serial')
 
-    # Binarize and invert
-    _, img_bin = cv2.threshold(img, 0, 255, cv2.THRESH_BINARY | cv2.THRESH_OTSU)
-    img_bin = 255 - img_bin
 
+# Cells read below this confidence are candidates for escalation.
+CELL_MIN_CONFIDENCE = float(os.getenv('CELL_MIN_CONFIDENCE', '0.5'))
+
+_PRESENT_MARKS = ('p', 'present', '✓', '✔', 'tick', 'yes', '1', 'true')
+_ABSENT_MARKS = ('', 'a', 'ab', 'absent')
+
+
+def _is_ambiguous_mark(text: str) -> bool:
+    """True for short attendance marks that are neither a known present nor absent token."""
+    m = str(text or '').strip().lower()
+    return m not in _PRESENT_MARKS and m not in _ABSENT_MARKS and len(m) <= 4
+
+
+_reader = None
+
+
+def _get_reader():
+    """Load the EasyOCR model once per process instead of once per upload."""
+    global _reader
+    if _reader is None:
+        _reader = easyocr.Reader(['en'])
+    return _reader
+
+
+def _read_cell(reader, crop, profile: str) -> tuple:
+    """Read one cell and return (text, mean confidence); blank cells give (text, None)."""
+    results = reader.readtext(crop, detail=1, paragraph=False, **OCR_PROFILES[profile])
+    if not results:
+        return '', None
+    text = " ".join(str(r[1]) for r in results).strip()
+    conf = float(sum(r[2] for r in results) / len(results))
+    return text, conf
+
+
+def _is_date_label(label: str) -> bool:
+    """True for header labels that look like a lecture date ('01/08', '12-Aug', 'Mon')."""
+    label = str(label or '').lower()
+    words = ''.join(ch if ch.isalpha() else ' ' for ch in label).split()
+    return any(ch.isdigit() for ch in label) or any(w in _DATE_WORDS for w in words)
+
+
+def _classify_header(header: List[str]) -> List[str]:
+    """Assign a column kind ('roll', 'id', 'name', 'date' or 'skip') to each header cell.
+
+    Cells up to the first date-like label are key columns. Serial-number
+    columns are skipped; other unrecognized labels (blank or unreadable) fill
+    a missing Roll No / Name by position and are otherwise skipped.
+    """
+    kinds = ['date'] * len(header)
+    unlabelled = []
+    for i, h in enumerate(header):
+        label = str(h or '').lower()
+        if _is_date_label(label):
+            break
+        words = ''.join(ch if ch.isalnum() else ' ' for ch in label).split()
+        if 'roll' in label and 'roll' not in kinds:
+            kinds[i] = 'roll'
+        elif 'name' in label and 'name' not in kinds:
+            kinds[i] = 'name'
+        elif any(k in words for k in ('id', 'sap', 'prn')) or 'student id' in label:
+            kinds[i] = 'skip' if 'id' in kinds else 'id'
+        elif (words and words[0] in _SERIAL_LABELS) or label.strip() == '#':
+            kinds[i] = 'skip'
+        else:
+            kinds[i] = 'skip'
+            unlabelled.append(i)
+
+    for key in ('roll', 'name'):
+        if key not in kinds and unlabelled:
+            kinds[unlabelled.pop(0)] = key
+    return kinds
+
+
+def _unique_labels(labels: List[str]) -> List[str]:
+    """Make lecture-date column labels unique; blank ones become 'Lecture <n>'."""
+    seen: Dict[str, int] = {}
+    unique = []
+    for n, label in enumerate(labels, start=1):
+        label = str(label or '').strip() or f"Lecture {n}"
+        if label in seen:
+            seen[label] += 1
+            label = f"{label} ({seen[label]})"
+        else:
+            seen[label] = 1
+        unique.append(label)
+    return unique
+
+
+def _detect_grid(img: np.ndarray, img_bin: np.ndarray) -> List[List[tuple]]:
+    """Find the table's cell boxes and group them into rows (header row first)."""
     contours, _ = cv2.findContours(img_bin, cv2.RETR_TREE, cv2.CHAIN_APPROX_SIMPLE)
     H, W = img.shape[:2]
     cells = []
@@ -151,225 +445,681 @@ def process_pdf_with_easyocr(pdf_path: str) -> pd.DataFrame | Dict[str, Any]:
         x, y, w, h = cv2.boundingRect(c)
         if (w > 20 and h > 20) and w < int(W * 0.9) and h < int(H * 0.25):
             cells.append((x, y, w, h))
-
-    reader = easyocr.Reader(['en'])
-
     if not cells:
-        lines = reader.readtext(img, detail=0, paragraph=True)
-        if not lines:
-            return {"error": "OCR could not detect any text in the PDF image."}
-        df = pd.DataFrame({'Raw': lines})
-        try:
-            os.remove(img_path)
-        except Exception:
-            pass
-        return df
+        return []
 
     cells.sort(key=lambda r: (r[1], r[0]))
     first_row_y = cells[0][1]
     num_cols = sum(1 for c in cells if abs(c[1] - first_row_y) < 10)
 
-    rows: List[List[str]] = []
-    row_acc: List[str] = []
-    for (x, y, w, h) in cells:
-        crop = img[y:y+h, x:x+w]
-        text = " ".join(reader.readtext(crop, detail=0, paragraph=True)).strip()
-        row_acc.append(text)
+    # Group cell boxes into table rows before reading anything, so the header
+    # can be read first and decide how every data column is recognized.
+    box_rows: List[List[tuple]] = []
+    row_acc: List[tuple] = []
+    for box in cells:
+        row_acc.append(box)
         if len(row_acc) == num_cols:
-            rows.append(row_acc)
+            box_rows.append(row_acc)
             row_acc = []
+    return box_rows
+
+
+# ---------- Cell-level escalation (low-confidence cells -> one Gemini call) ----------
+
+CELL_ESCALATION = os.getenv('CELL_ESCALATION', '1') in ('1', 'true', 'True')
+CELL_ESCALATION_MAX = int(os.getenv('CELL_ESCALATION_MAX', '80'))
+MOSAIC_CELLS = 40
+MOSAIC_WIDTH = 1200
+MOSAIC_TILE_HEIGHT = 64
+MOSAIC_LABEL_WIDTH = 70
+
+_CELL_KIND_HINTS = {
+    'roll': 'roll number (digits only)',
+    'id': 'student ID (digits only)',
+    'name': "student's name",
+    'date': "attendance mark: answer 'Present' or 'Absent'",
+}
+
+
+def _build_mosaics(cells: List[Dict[str, Any]]) -> List[Image.Image]:
+    """Pack cell crops into labelled mosaic images, MOSAIC_CELLS tiles per image."""
+    mosaics = []
+    for start in range(0, len(cells), MOSAIC_CELLS):
+        tiles = []
+        for index, cell in enumerate(cells[start:start + MOSAIC_CELLS], start=start):
+            crop = cell['crop']
+            h, w = crop.shape[:2]
+            scale = MOSAIC_TILE_HEIGHT / max(h, 1)
+            tile_w = min(MOSAIC_WIDTH - MOSAIC_LABEL_WIDTH, max(1, int(w * scale)))
+            tile = np.full((MOSAIC_TILE_HEIGHT, MOSAIC_WIDTH), 255, dtype=np.uint8)
+            tile[:, MOSAIC_LABEL_WIDTH:MOSAIC_LABEL_WIDTH + tile_w] = cv2.resize(crop, (tile_w, MOSAIC_TILE_HEIGHT))
+            cv2.putText(tile, f"#{index}", (4, MOSAIC_TILE_HEIGHT // 2 + 8), cv2.FONT_HERSHEY_SIMPLEX, 0.8, 0, 2)
+            cv2.line(tile, (0, MOSAIC_TILE_HEIGHT - 1), (MOSAIC_WIDTH - 1, MOSAIC_TILE_HEIGHT - 1), 128, 1)
+            tiles.append(tile)
+        mosaics.append(Image.fromarray(np.vstack(tiles)))
+    return mosaics
+
+
+def create_cell_prompt(cells: List[Dict[str, Any]]) -> str:
+    hints = "\n".join(f"        #{i}: {_CELL_KIND_HINTS[c['kind']]}" for i, c in enumerate(cells))
+    return (
+        """
+        The attached images are mosaics of individual cells cropped from a handwritten attendance sheet.
+        Each row of a mosaic is one cell, labelled on the left with its index (e.g. #0, #1).
+        Transcribe every labelled cell and return a single JSON object with one key, "cells":
+        a list of objects {"index": <int>, "text": <string>}. Do not include any text before or after the JSON.
+
+        What each index contains:
+"""
+        + hints + "\n"
+    )
 
-    if not rows or not rows[0]:
-        return {"error": "Failed to reconstruct table from OCR results."}
 
-    header = [str(h or '').strip() for h in rows[0]]
-    data_rows = rows[1:] if len(rows) > 1 else []
+def _resolve_cells_with_gemini(cells: List[Dict[str, Any]],
+                               deadline: Deadline | None = None) -> Dict[int, str] | Dict[str, Any]:
+    """Resolve all escalated cells in one batched request; returns {index: text}."""
+    parts: List[Any] = [create_cell_prompt(cells)] + _build_mosaics(cells)
+    text = _generate_content('cells', parts, deadline)
+    if isinstance(text, dict):
+        return text
+    data = _parse_gemini_json(text)
+    answers = {}
+    for item in data.get('cells', []):
+        try:
+            answers[int(item.get('index'))] = str(item.get('text', '')).strip()
+        except (TypeError, ValueError):
+            continue
+    return answers
 
-    df = pd.DataFrame(data_rows, columns=header)
 
-    # Map key columns best-effort
-    cols = list(df.columns)
-    if len(cols) >= 1:
-        df.rename(columns={cols[0]: 'Roll No'}, inplace=True)
-    if len(cols) >= 2:
-        df.rename(columns={cols[1]: 'Name'}, inplace=True)
-    if 'Student ID' not in df.columns:
-        df['Student ID'] = ''
+def escalate_uncertain_cells(df: pd.DataFrame, cells: List[Dict[str, Any]], resolver=None,
+                             deadline: Deadline | None = None) -> Dict[str, Any]:
+    """Re-read cells the recognizer flagged as uncertain and merge the answers into df.
 
-    date_cols = [c for c in df.columns if c not in ('Roll No', 'Student ID', 'Name')]
+    Only the lowest-confidence CELL_ESCALATION_MAX cells are sent. `resolver`
+    defaults to the batched Gemini call and can be swapped for a local stub.
+    Returns a small stats dict for the response payload. Escalation is skipped
+    when the request's deadline has already passed.
+    """
+    stats: Dict[str, Any] = {'candidates': len(cells), 'sent': 0, 'resolved': 0}
+    if not CELL_ESCALATION or not cells:
+        return stats
+    if deadline is not None:
+        if deadline.cancelled():
+            raise DeadlineExceeded('escalate', cancelled=True)
+        if deadline.expired():
+            stats['skipped'] = 'deadline'
+            return stats
+
+    cells = sorted(cells, key=lambda c: c['confidence'])[:CELL_ESCALATION_MAX]
+    stats['sent'] = len(cells)
+    stats['mosaics'] = -(-len(cells) // MOSAIC_CELLS)
+
+    start = time.perf_counter()
+    try:
+        answers = resolver(cells) if resolver else _resolve_cells_with_gemini(cells, deadline)
+    except DeadlineExceeded:
+        raise
+    except Exception as e:
+        answers = {"error": f"Cell escalation failed: {e}"}
+    stats['latency_ms'] = _elapsed_ms(start)
+    if isinstance(answers, dict) and 'error' in answers:
+        stats['error'] = answers['error']
+        return stats
+
+    for index, text in answers.items():
+        if not 0 <= index < len(cells):
+            continue
+        cell = cells[index]
+        if cell['kind'] == 'date':
+            value = 'Present' if text.strip().lower() in _PRESENT_MARKS else 'Absent'
+        elif cell['kind'] in ('roll', 'id'):
+            value = ''.join(ch for ch in text if ch.isdigit())
+        else:
+            value = text
+        df.iat[cell['row'], cell['col_pos']] = value
+        stats['resolved'] += 1
+    return stats
+
+
+def _elapsed_ms(start: float) -> float:
+    return round((time.perf_counter() - start) * 1000, 1)
+
+
+# ---------- Photo preprocessing (perspective, deskew, illumination) ----------
+
+# Photos whose local OCR confidence falls below this are sent to Gemini instead.
+LOCAL_OCR_MIN_CONFIDENCE = float(os.getenv('LOCAL_OCR_MIN_CONFIDENCE', '0.6'))
+LOCAL_PHOTO_PIPELINE = os.getenv('LOCAL_PHOTO_PIPELINE', '1') in ('1', 'true', 'True')
+
+
+def _normalize_illumination(gray: np.ndarray) -> np.ndarray:
+    # Estimate the paper background with a large closing and divide it out,
+    # which flattens shadows and uneven lighting across the sheet.
+    k = max(15, min(gray.shape[:2]) // 30) | 1
+    kernel = cv2.getStructuringElement(cv2.MORPH_RECT, (k, k))
+    background = cv2.morphologyEx(gray, cv2.MORPH_CLOSE, kernel)
+    return cv2.divide(gray, background, scale=255)
+
+
+def _find_page_quad(gray: np.ndarray) -> np.ndarray | None:
+    """Return the four corners of the sheet if it stands out as a large quadrilateral."""
+    H, W = gray.shape[:2]
+    edges = cv2.Canny(cv2.GaussianBlur(gray, (5, 5), 0), 50, 150)
+    edges = cv2.dilate(edges, np.ones((3, 3), np.uint8))
+    contours, _ = cv2.findContours(edges, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+    for c in sorted(contours, key=cv2.contourArea, reverse=True)[:5]:
+        approx = cv2.approxPolyDP(c, 0.02 * cv2.arcLength(c, True), True)
+        if len(approx) == 4 and cv2.contourArea(approx) > 0.4 * H * W:
+            return approx.reshape(4, 2).astype(np.float32)
+    return None
 
-    def norm_att(v: str) -> str:
-        m = str(v or '').strip().lower()
-        if m in ('p', 'present', '✓', '✔', 'tick', 'yes', '1', 'true') or len(m) > 4:
-            return 'Present'
-        return 'Absent'
-
-    for c in date_cols:
-        df[c] = df[c].astype(str).apply(norm_att)
 
+def _warp_to_quad(gray: np.ndarray, quad: np.ndarray) -> np.ndarray:
+    # Order corners as top-left, top-right, bottom-right, bottom-left.
+    s = quad.sum(axis=1)
+    d = np.diff(quad, axis=1).ravel()
+    tl, br = quad[np.argmin(s)], quad[np.argmax(s)]
+    tr, bl = quad[np.argmin(d)], quad[np.argmax(d)]
+    src = np.array([tl, tr, br, bl], dtype=np.float32)
+
+    width = int(max(np.linalg.norm(br - bl), np.linalg.norm(tr - tl)))
+    height = int(max(np.linalg.norm(tr - br), np.linalg.norm(tl - bl)))
+    dst = np.array([[0, 0], [width - 1, 0], [width - 1, height - 1], [0, height - 1]], dtype=np.float32)
+    M = cv2.getPerspectiveTransform(src, dst)
+    return cv2.warpPerspective(gray, M, (width, height), borderValue=255)
+
+
+def _estimate_skew(gray: np.ndarray) -> float:
+    """Median angle (degrees) of the sheet's horizontal ruling lines."""
+    H, W = gray.shape[:2]
+    _, img_bin = cv2.threshold(gray, 0, 255, cv2.THRESH_BINARY_INV | cv2.THRESH_OTSU)
+    kernel = cv2.getStructuringElement(cv2.MORPH_RECT, (max(10, W // 30), 1))
+    lines_mask = cv2.morphologyEx(img_bin, cv2.MORPH_OPEN, kernel)
+    lines = cv2.HoughLinesP(lines_mask, 1, np.pi / 180, threshold=100, minLineLength=W // 4, maxLineGap=20)
+    if lines is None:
+        return 0.0
+    angles = []
+    # OpenCV 4 returns (N, 1, 4) and OpenCV 5 (N, 4).
+    for x1, y1, x2, y2 in lines.reshape(-1, 4):
+        angle = np.degrees(np.arctan2(y2 - y1, x2 - x1))
+        if abs(angle) < 15:
+            angles.append(angle)
+    return float(np.median(angles)) if angles else 0.0
+
+
+_REDUCED_READ_FLAGS = {
+    1: cv2.IMREAD_GRAYSCALE,
+    2: cv2.IMREAD_REDUCED_GRAYSCALE_2,
+    4: cv2.IMREAD_REDUCED_GRAYSCALE_4,
+    8: cv2.IMREAD_REDUCED_GRAYSCALE_8,
+}
+
+
+def _photo_read_flag(path: str) -> int:
+    """imread flag that decodes an oversized photo at reduced resolution.
+
+    The size comes from the file header, so a large phone photo is never
+    decoded at full resolution just to be scaled down to MAX_PAGE_PIXELS.
+    """
     try:
-        os.remove(img_path)
+        with Image.open(path) as im:
+            factor = memory_governor.decode_reduction(*im.size)
     except Exception:
-        pass
+        factor = 1
+    return _REDUCED_READ_FLAGS[factor]
 
-    # Ensure column order
-    df = df[['Roll No', 'Student ID', 'Name'] + date_cols]
-    return df
 
+def preprocess_photo(path: str) -> np.ndarray | Dict[str, Any]:
+    """Turn a phone photo of a sheet into a flat, upright grayscale page for grid detection."""
+    img = cv2.imread(path, _photo_read_flag(path))
+    if img is None:
+        return {"error": "Could not read the uploaded image file."}
+    W, H = memory_governor.capped_size(img.shape[1], img.shape[0])
+    if (W, H) != (img.shape[1], img.shape[0]):
+        img = cv2.resize(img, (W, H), interpolation=cv2.INTER_AREA)
+
+    # Find the sheet before flattening the lighting: normalization also
+    # flattens the sheet/desk edge the quad is found from.
+    quad = _find_page_quad(img)
+    if quad is not None:
+        img = _warp_to_quad(img, quad)
+    img = _normalize_illumination(img)
+
+    angle = _estimate_skew(img)
+    if abs(angle) > 0.3:
+        H, W = img.shape[:2]
+        M = cv2.getRotationMatrix2D((W / 2, H / 2), angle, 1.0)
+        img = cv2.warpAffine(img, M, (W, H), flags=cv2.INTER_LINEAR, borderValue=255)
+    return img
+
+
+# ---------- Stage values ----------
+# Typed values passed between pipeline stages:
+# ingest -> Upload -> rasterize -> Page -> detect_grid -> Grid -> recognize -> Table
+# -> classify_marks -> Table -> build_report -> dict
+
+@dataclass
+class Upload:
+    path: str
+    kind: str  # 'pdf' or 'photo'
+
+
+@dataclass
+class Page:
+    img: np.ndarray  # grayscale, upright page
+
+
+@dataclass
+class Grid:
+    page: Page
+    box_rows: List[List[tuple]]  # header row first; empty when no grid was found
+    header: List[str] = field(default_factory=list)
+    kinds: List[str] = field(default_factory=list)
+    layout: Dict[str, Any] = field(default_factory=dict)
+
+
+@dataclass
+class Table:
+    df: pd.DataFrame
+    dates: List[str] | None = None
+    confidence: float = 0.0
+    uncertain: List[Dict[str, Any]] = field(default_factory=list)
+    layout: Dict[str, Any] | None = None
+    partial: Dict[str, Any] | None = None
+    escalation: Dict[str, Any] | None = None
+    marks_classified: bool = False
+
+    @property
+    def cacheable(self) -> bool:
+        # A deadline-truncated read must not be served to later requests.
+        return self.partial is None
+
+    @property
+    def is_grid(self) -> bool:
+        return len(self.df.columns) > 3
+
+
+PIPELINE = Pipeline([
+    Stage('ingest', str, Upload, 'file'),
+    Stage('rasterize', Upload, Page, lambda upload, ctx: upload.kind),
+    Stage('detect_grid', Page, Grid, 'opencv'),
+    Stage('recognize', (Grid, Upload), Table, 'easyocr'),
+    Stage('classify_marks', Table, Table, 'rules'),
+    Stage('build_report', Table, dict, 'pandas'),
+])
+
+
+# ---------- Stage backends ----------
+
+@PIPELINE.backend('ingest', 'file')
+def _ingest_file(path: str, ctx: RunContext) -> Upload | Dict[str, Any]:
+    if not os.path.exists(path):
+        return {"error": "Uploaded file could not be found."}
+    digest = hashlib.sha256()
+    with open(path, 'rb') as fh:
+        for chunk in iter(lambda: fh.read(1024 * 1024), b''):
+            digest.update(chunk)
+    ctx.content_hash = digest.hexdigest()
+    kind = 'pdf' if os.path.splitext(path)[1].lower() == '.pdf' else 'photo'
+    return Upload(path=path, kind=kind)
+
+
+@PIPELINE.backend('rasterize', 'pdf')
+def _rasterize_pdf(upload: Upload, ctx: RunContext, page_number: int = 0, dpi: int = 300) -> Page | Dict[str, Any]:
+    try:
+        doc = fitz.open(upload.path)
+        try:
+            page = doc.load_page(page_number)
+            # Large pages (e.g. A3) are rendered at a lower DPI to stay under the pixel cap.
+            dpi = memory_governor.capped_dpi(page.rect.width, page.rect.height, dpi)
+            pix = page.get_pixmap(dpi=dpi, colorspace=fitz.csGRAY, alpha=False)
+            img = np.frombuffer(pix.samples, dtype=np.uint8).reshape(pix.height, pix.stride)[:, :pix.width].copy()
+            pix = None
+        finally:
+            doc.close()
+    except Exception as e:
+        return {"error": f"Failed to convert PDF to image: {e}"}
+    return Page(img=img)
 
-# ---------- Public entry used by Flask ----------
 
-def process_image(path: str) -> Dict[str, Any]:
-    ext = os.path.splitext(path)[1].lower()
+@PIPELINE.backend('rasterize', 'photo')
+def _rasterize_photo(upload: Upload, ctx: RunContext) -> Page | Dict[str, Any]:
+    img = preprocess_photo(upload.path)
+    if isinstance(img, dict):
+        return img
+    return Page(img=img)
 
-    # PDF -> OCR pipeline
-    if ext == '.pdf':
-        df_or_err = process_pdf_with_easyocr(path)
-        if isinstance(df_or_err, dict) and df_or_err.get('error'):
-            return df_or_err
-        if isinstance(df_or_err, pd.DataFrame):
-            return _build_reports_from_dataframe(df_or_err)
-        return {"error": "Unexpected OCR output."}
-
-    # Images -> Gemini pipeline
-    err = _configure_gemini_or_error()
-    if err:
-        return err
 
-    model = genai.GenerativeModel('gemini-1.5-flash-latest')
-    image = Image.open(path)
-    prompt = create_gemini_prompt()
+@PIPELINE.backend('detect_grid', 'opencv')
+def _detect_grid_opencv(page: Page, ctx: RunContext) -> Grid:
+    """Find the cell grid and parse the header, trying the subject's cached layout first."""
+    img = page.img
+    # Binarize and invert
+    _, img_bin = cv2.threshold(img, 0, 255, cv2.THRESH_BINARY | cv2.THRESH_OTSU)
+    img_bin = 255 - img_bin
 
-    response = model.generate_content([prompt, image])
-    data = _parse_gemini_json(response.text)
+    subject = ctx.subject
+    layout = layout_cache.match_template(subject, img_bin) if subject else {'status': 'disabled'}
+    if layout['status'] == 'hit':
+        box_rows, kinds = layout.pop('box_rows'), layout.pop('kinds')
+        if ctx.deadline is not None:
+            ctx.deadline.check('read header')
+        # The layout is cached but the lecture dates change every week.
+        header = _read_header(img, box_rows[0], kinds)
+        return Grid(page=page, box_rows=box_rows, header=header, kinds=kinds, layout=layout)
+
+    box_rows = _detect_grid(img, img_bin)
+    if not box_rows:
+        return Grid(page=page, box_rows=[], layout=layout)
+
+    if ctx.deadline is not None:
+        ctx.deadline.check('read header')
+    header = _read_header(img, box_rows[0])
+    kinds = _classify_header(header)
+    if subject:
+        layout_cache.store_template(subject, img_bin, box_rows, kinds)
+    return Grid(page=page, box_rows=box_rows, header=header, kinds=kinds, layout=layout)
+
+
+def _read_header(img: np.ndarray, header_boxes: List[tuple], kinds: List[str] | None = None) -> List[str]:
+    """Read the header row; with known column kinds only the date cells are read.
+
+    Without kinds, cells are read as free text until the first date-like label.
+    """
+    reader = _get_reader()
+    header = []
+    leading = kinds is None
+    for i, box in enumerate(header_boxes):
+        if leading:
+            text = _read_cell(reader, _crop(img, box), 'text')[0]
+            leading = not _is_date_label(text)
+            header.append(text)
+            continue
+        if kinds is not None and kinds[i] != 'date':
+            header.append('')
+            continue
+        header.append(_read_cell(reader, _crop(img, box), 'date')[0])
+    return header
+
+
+def _crop(img: np.ndarray, box: tuple) -> np.ndarray:
+    x, y, w, h = box
+    return img[y:y+h, x:x+w]
+
+
+def _recognize_cache_key(ctx: RunContext):
+    return (ctx.content_hash, ctx.subject) if ctx.content_hash else None
+
+
+@PIPELINE.backend('recognize', 'easyocr', cache_key=_recognize_cache_key)
+def _recognize_easyocr(grid: Grid, ctx: RunContext) -> Table | Dict[str, Any]:
+    """OCR every data cell with its column's profile.
+
+    Records the mean confidence of non-blank cells and the cells worth
+    escalating. If the deadline runs out after some rows were read, the rows so
+    far are returned with `partial` set.
+    """
+    if not isinstance(grid, Grid):
+        return {"error": "Local OCR needs a detected page grid."}
+    img = grid.page.img
+    # Without a grid there is no table to read: a photo goes to Gemini and a
+    # PDF has no report, so a full-page read would be thrown away.
+    if not grid.box_rows:
+        return {"error": "Could not find an attendance table in the sheet."}
+    reader = _get_reader()
+
+    kinds = grid.kinds
+    confidences: List[float] = []
+    # Cells the recognizer or the mark rules are unsure about, kept with their
+    # crops so a later stage can escalate just these instead of the whole page.
+    uncertain: List[Dict[str, Any]] = []
+    data_rows: List[List[str]] = []
+    partial = None
+    for r, box_row in enumerate(grid.box_rows[1:]):
+        # Check between rows: a cancelled request stops at once, an expired one
+        # keeps what it has read so far.
+        if ctx.deadline is not None:
+            try:
+                ctx.deadline.check('recognize')
+            except DeadlineExceeded as exc:
+                if exc.cancelled or not data_rows:
+                    raise
+                partial = {'rows_read': len(data_rows), 'rows_total': len(grid.box_rows) - 1}
+                break
+        row_text = []
+        for i, (box, kind) in enumerate(zip(box_row, kinds)):
+            if kind == 'skip':
+                row_text.append('')
+                continue
+            text, conf = _read_cell(reader, _crop(img, box), COLUMN_PROFILES[kind])
+            row_text.append(text)
+            if conf is None:
+                continue
+            confidences.append(conf)
+            if conf < CELL_MIN_CONFIDENCE or (kind == 'date' and _is_ambiguous_mark(text)):
+                uncertain.append({'row': r, 'col_pos': i, 'kind': kind, 'text': text,
+                                  'confidence': conf, 'crop': _crop(img, box).copy()})
+        data_rows.append(row_text)
+
+    # Key columns are named by kind; skipped columns (e.g. serial numbers) are dropped.
+    key_names = {'roll': 'Roll No', 'id': 'Student ID', 'name': 'Name'}
+    keep = [i for i, kind in enumerate(kinds) if kind != 'skip']
+    # Duplicate date labels (e.g. a misread header) would make df[c] a frame.
+    date_labels = iter(_unique_labels([grid.header[i] for i in keep if kinds[i] == 'date']))
+    df = pd.DataFrame([[row[i] for i in keep] for row in data_rows],
+                      columns=[key_names[kinds[i]] if kinds[i] in key_names else next(date_labels) for i in keep])
+    del data_rows
+    # Key columns the header did not contain are left blank.
+    for name in key_names.values():
+        if name not in df.columns:
+            df[name] = ''
+
+    date_cols = [c for c in df.columns if c not in ('Roll No', 'Student ID', 'Name')]
+    # Ensure column order
+    df = df[['Roll No', 'Student ID', 'Name'] + date_cols]
+
+    # Translate header positions of uncertain cells into final column positions.
+    date_positions = [i for i, kind in enumerate(kinds) if kind == 'date']
+    final_pos = {i: 3 + k for k, i in enumerate(date_positions)}
+    final_pos.update({i: ('roll', 'id', 'name').index(kind) for i, kind in enumerate(kinds) if kind in key_names})
+    for cell in uncertain:
+        cell['col_pos'] = final_pos[cell['col_pos']]
+
+    return Table(
+        df=df,
+        confidence=float(np.mean(confidences)) if confidences else 0.0,
+        uncertain=uncertain,
+        layout=grid.layout,
+        partial=partial,
+    )
+
+
+@PIPELINE.backend('recognize', 'gemini')
+def _recognize_gemini(value: Grid | Upload, ctx: RunContext) -> Table | Dict[str, Any]:
+    """Whole-sheet extraction by Gemini, coalesced with other pending sheets."""
+    image = _load_sheet_image(ctx.path)
+    if _batching_enabled():
+        data = _sheet_batcher.submit(image, ctx.deadline)
+    else:
+        data = _extract_sheets_with_gemini([image], ctx.deadline)[0]
+    return _table_from_gemini_data(data)
 
+
+def _table_from_gemini_data(data: Dict[str, Any]) -> Table | Dict[str, Any]:
+    if data.get('error'):
+        return data
     dates = [str(d).strip() for d in data.get('dates', [])]
     students = data.get('students', [])
     if not dates or not students:
         return {"error": "Gemini could not extract valid date or student records from the image."}
+    return Table(df=_normalize_records_to_df(dates, students), dates=dates, confidence=1.0,
+                 marks_classified=True)
 
-    df = _normalize_records_to_df(dates, students)
-    return _build_reports_from_dataframe(df, dates)
-import json
-import pandas as pd
-import numpy as np
-from PIL import Image
-from dotenv import load_dotenv, find_dotenv
-import cv2  # OpenCV for image processing
-import fitz  # PyMuPDF for PDF handling
-import easyocr  # For OCR
-import google.generativeai as genai
 
-# --- 1. LOAD ENVIRONMENT VARIABLES ---
-# Load .env if present, but do NOT fail at import time if keys are missing.
-# This prevents server import errors when the environment isn't configured.
-DOTENV_DEFAULT = os.path.join(os.path.dirname(__file__), '.env')
-dotenv_path = DOTENV_DEFAULT if os.path.exists(DOTENV_DEFAULT) else find_dotenv()
-if dotenv_path:
-    load_dotenv(dotenv_path)
+@PIPELINE.backend('classify_marks', 'rules')
+def _classify_marks(table: Table, ctx: RunContext) -> Table:
+    """Turn raw mark text into Present/Absent, then escalate the uncertain cells."""
+    if table.marks_classified or not table.is_grid:
+        return table
 
-def _ensure_genai_configured():
-    """Ensure the Google Gemini (generativeai) SDK is configured.
+    # Work on copies: the recognized table may be shared through the stage cache.
+    df = table.df.copy()
+    uncertain = [dict(cell) for cell in table.uncertain]
+    date_cols = [c for c in df.columns if c not in ('Roll No', 'Student ID', 'Name')]
 
-    Returns (True, None) on success or (False, error_message) on failure.
-    This is intentionally non-fatal so importing this module doesn't raise.
- # --- 2. GEMINI CONFIG (lazy) ---
-# We configure Gemini only when needed, so PDF OCR can run without a key.
-def _configure_gemini_or_error():
-    api_key = os.getenv("GOOGLE_API_KEY")
-    if not api_key:
-        return {"error": "Your Gemini API key is not valid or missing. Set GOOGLE_API_KEY in your .env file."}
-    try:
-        genai.configure(api_key=api_key)
-        return None
-    except Exception as e:
-        return {"error": f"Failed to configure Gemini API: {e}"}
+    def norm_att(v: str) -> str:
+        m = str(v or '').strip().lower()
+        if m in _PRESENT_MARKS or len(m) > 4:
+            return 'Present'
+        return 'Absent'
 
+    for c in date_cols:
+        df[c] = df[c].astype(str).apply(norm_att)
 
-def create_gemini_prompt():
-    """Creates the detailed prompt for the Gemini API."""
-{{ ... }}
-    cleaned = (text or "").strip()
-    cleaned = cleaned.replace("```json", "").replace("```", "").strip()
-    return json.loads(cleaned)
+    escalation = escalate_uncertain_cells(df, uncertain, deadline=ctx.deadline)
+    return Table(df=df, dates=table.dates, confidence=table.confidence, layout=table.layout,
+                 partial=table.partial, escalation=escalation, marks_classified=True)
 
 
-def _normalize_records_to_df(dates,        # --- 6. CONSTRUCT THE PANDAS DATAFRAME ---
-        processed_data = []
-        for record in student_records:
-            row = {
-                'Roll No': record.get('roll_no', ''),
-                'Student ID': record.get('student_id', ''),
-                'Name': record.get('name', '')
-            }
-        att = record.get('attendance', []) or []
-        for i, date in enumerate(dates):
-            raw = ''
-            if i < len(att):
-                raw = str(att[i]).strip().lower()
-{{ ... }}
-        'anomalies': df[df['Anomaly'] != ''].to_dict(orient='records'),
-    }
+@PIPELINE.backend('build_report', 'pandas')
+def _build_report(table: Table, ctx: RunContext) -> Dict[str, Any]:
+    if not table.is_grid:
+        return {"error": "Could not find an attendance table in the sheet."}
+    results = _build_reports_from_dataframe(table.df, table.dates)
+    if table.escalation is not None:
+        results['escalation'] = table.escalation
+    if table.layout and table.layout.get('status') != 'disabled':
+        results['layout'] = table.layout
+    if table.partial:
+        results['partial'] = table.partial
+    return results
 
 
-def process_image(image_path: str):
-    """
-    Processes the attendance sheet. If a PDF is provided, uses EasyOCR+OpenCV.
-    Otherwise, uses Gemini for image understanding.
+def _load_sheet_image(path: str) -> Image.Image:
+    image = Image.open(path)
+    image.thumbnail(memory_governor.capped_size(*image.size))
+    return image
+
+
+# ---------- Public entry used by Flask ----------
+
+def _route_photo_locally(upload: Upload, ctx: RunContext) -> tuple:
+    """Run the local photo path; returns (results or None, routing, local_table).
+
+    Results are returned when the local read is trusted; otherwise the caller
+    is expected to ask Gemini, keeping local_table as a fallback.
     """
-    try:
-        # Route PDFs to OCR pipeline
-        ext = os.path.splitext(image_path)[1].lower()
-        if ext == '.pdf':
-            df = process_pdf_with_easyocr(image_path)
-            if isinstance(df, dict) and df.get('error'):
-                return df
-            return _build_reports_from_dataframe(df)
-
-        # For images, use Gemini
-        err = _configure_gemini_or_error()
-        if err:
-            return err
-        prompt = create_gemini_prompt()
-
-        response = model.generate_content([prompt, image])
-        data = _parse_gemini_json(response.text)
-
-        dates = [str(d).strip() for d in data.get('dates', [])]
-        student_records = data.get('students', [])
-        if not dates or not student_records:
-            return {"error": "Gemini could not extract valid date or student records from the image."}
-
-        return _normalize_records_to_df(dates, student_records)
+    routing: Dict[str, Any] = {'path': 'gemini', 'confidence': None, 'latency_ms': {}}
+    local_table = None
+    if LOCAL_PHOTO_PIPELINE:
+        start = time.perf_counter()
+        table = PIPELINE.run(upload, ctx, start='rasterize', stop='recognize')
+        routing['latency_ms']['local'] = _elapsed_ms(start)
+        if isinstance(table, Table) and table.is_grid:
+            local_table = table
+            routing['confidence'] = round(table.confidence, 3)
+            # A partial local read means the budget is gone; there is no time left for Gemini.
+            if routing['confidence'] >= LOCAL_OCR_MIN_CONFIDENCE or table.partial:
+                routing['path'] = 'local'
+                results = PIPELINE.run(table, ctx, start='classify_marks')
+                if not results.get('error'):
+                    results['routing'] = routing
+                return results, routing, local_table
+    return None, routing, local_table
+
+
+def _finish_photo(table: Table | Dict[str, Any], routing: Dict[str, Any],
+                  local_table: Table | None, ctx: RunContext) -> Dict[str, Any]:
+    # Without a usable Gemini answer, a low-confidence local table beats an error.
+    if isinstance(table, dict) and table.get('error'):
+        if local_table is None:
+            return table
+        routing['path'] = 'local'
+        routing['fallback_reason'] = table['error']
+        table = Table(df=local_table.df, confidence=local_table.confidence)
+
+    results = PIPELINE.run(table, ctx, start='classify_marks')
+    if not results.get('error'):
+        results['routing'] = routing
+    return results
+
+
+def _with_timings(results: Dict[str, Any], ctx: RunContext) -> Dict[str, Any]:
+    if isinstance(results, dict) and not results.get('error'):
+        results['timings_ms'] = ctx.timings_ms
+        results['backends'] = ctx.backends_used
+        if ctx.cache_hits:
+            results['cache_hits'] = ctx.cache_hits
+    return results
+
+
+def _process(ctx: RunContext) -> Dict[str, Any]:
+    upload = PIPELINE.run(ctx.path, ctx, stop='ingest')
+    if isinstance(upload, dict):
+        return upload
 
-    except Exception as e:
-        if "API key not valid" in str(e):
-            return {"error": "Your Gemini API key is not valid. Please check your GOOGLE_API_KEY in the .env file."}
-        return {"error": f"An unexpected error occurred: {str(e)}"}
+    # PDF -> OCR pipeline
+    if upload.kind == 'pdf':
+        return PIPELINE.run(upload, ctx, start='rasterize')
 
+    # Images -> local OCR first, Gemini only when the local result is not trusted
+    results, routing, local_table = _route_photo_locally(upload, ctx)
+    if results is not None:
+        return results
 
-def process_pdf(pdf_path: str):
-    """Processes an attendance PDF via the Gemini API and returns structured results."""
-    try:
-        ok, err = _ensure_genai_configured()
-        if not ok:
-            return {"error": f"Gemini not configured: {err}. Set GOOGLE_API_KEY in your environment or .env."}
+    start = time.perf_counter()
+    table = PIPELINE.run(upload, ctx, start='recognize', stop='recognize', backends={'recognize': 'gemini'})
+    routing['latency_ms']['gemini'] = _elapsed_ms(start)
+    return _finish_photo(table, routing, local_table, ctx)
 
-        model = genai.GenerativeModel('gemini-1.5-flash')
-        prompt = create_gemini_prompt()
 
-        uploaded_pdf = genai.upload_file(pdf_path, mime_type='application/pdf')
-        response = model.generate_content([prompt, uploaded_pdf])
+def process_image(path: str, subject: str | None = None, deadline: Deadline | None = None) -> Dict[str, Any]:
+    """Process an uploaded sheet (PDF or photo) into attendance reports.
+
+    `subject` selects the cached layout template. `deadline` is checked
+    between pipeline stages and OCR rows; when it fires the work stops and a
+    timeout error dict is returned instead.
+    """
+    ctx = RunContext(path=path, subject=subject, deadline=deadline)
+    try:
+        return _with_timings(_process(ctx), ctx)
+    except DeadlineExceeded as exc:
+        return timeout_error(exc)
 
-        data = _parse_gemini_json(response.text)
-        dates = [str(d).strip() for d in data.get('dates', [])]
-        student_records = data.get('students', [])
-        if not dates or not student_records:
-            return {"error": "Gemini could not extract valid date or student records from the PDF."}
 
-        return _normalize_records_to_df(dates, student_records)
+def process_images(paths: List[str], deadline: Deadline | None = None) -> List[Dict[str, Any]]:
+    """Process a bulk upload; photos that need Gemini share batched requests.
 
-    except Exception as e:
-        if "API key not valid" in str(e):
-            return {"error": "Your Gemini API key is not valid. Please check your GOOGLE_API_KEY in the .env file."}
-        return {"error": f"An unexpected error occurred: {str(e)}"}
+    Returns one result (or error dict) per path, in order.
+    """
+    results: List[Dict[str, Any] | None] = [None] * len(paths)
+    pending = []
+    try:
+        for i, path in enumerate(paths):
+            ctx = RunContext(path=path, deadline=deadline)
+            upload = PIPELINE.run(path, ctx, stop='ingest')
+            if isinstance(upload, dict):
+                results[i] = upload
+            elif upload.kind == 'pdf':
+                results[i] = _with_timings(PIPELINE.run(upload, ctx, start='rasterize'), ctx)
+            else:
+                local_results, routing, local_table = _route_photo_locally(upload, ctx)
+                if local_results is not None:
+                    results[i] = _with_timings(local_results, ctx)
+                else:
+                    pending.append((i, ctx, routing, local_table))
+
+        if pending:
+            start = time.perf_counter()
+            answers = _extract_sheets_with_gemini([_load_sheet_image(ctx.path) for _, ctx, _, _ in pending], deadline)
+            elapsed = _elapsed_ms(start)
+            for (i, ctx, routing, local_table), data in zip(pending, answers):
+                routing['latency_ms']['gemini'] = elapsed
+                routing['batched_with'] = len(pending)
+                table = _table_from_gemini_data(data)
+                results[i] = _with_timings(_finish_photo(table, routing, local_table, ctx), ctx)
+    except DeadlineExceeded as exc:
+        error = timeout_error(exc)
+        results = [r if r is not None else error for r in results]
+    return results
@@ -0,0 +1,85 @@
+import io
+import os
+
+import pytest
+
+np = pytest.importorskip('numpy')
+pytest.importorskip('cv2')
+pytest.importorskip('fitz')
+pytest.importorskip('easyocr')
+pytest.importorskip('google.generativeai')
+
+import app as app_module  # noqa: E402
+import deadlines  # noqa: E402
+import exports  # noqa: E402
+import processing  # noqa: E402
+
+
+@pytest.fixture
+def client(tmp_path, monkeypatch):
+    monkeypatch.setitem(app_module.app.config, 'UPLOAD_FOLDER', str(tmp_path))
+    monkeypatch.setattr(exports, 'REPORTS_FOLDER', str(tmp_path / 'reports'))
+    app_module.app.config['TESTING'] = True
+    return app_module.app.test_client()
+
+
+def test_batch_timeout_removes_uploads(client, tmp_path, monkeypatch):
+    timeout = {'error': 'Processing stopped during recognize: time budget exhausted.',
+               'timeout': True, 'stage': 'recognize', 'cancelled': False}
+    monkeypatch.setattr(processing, 'process_images', lambda paths, deadline: [dict(timeout) for _ in paths])
+    data = {'files': [(io.BytesIO(b'a'), 'one.png'), (io.BytesIO(b'b'), 'two.png')]}
+    resp = client.post('/api/process/batch', data=data, content_type='multipart/form-data')
+    assert resp.status_code == 504
+    assert [item['stage'] for item in resp.get_json()['results']] == ['recognize', 'recognize']
+    assert not [f for f in os.listdir(tmp_path) if f.endswith('.png')]
+
+
+def test_batch_uploads_stay_in_upload_folder_with_unique_names(client, tmp_path, monkeypatch):
+    seen = []
+    monkeypatch.setattr(processing, 'process_images',
+                        lambda paths, deadline: seen.extend(paths) or [{'error': 'no grid'} for _ in paths])
+    data = {'files': [(io.BytesIO(b'a'), '../../escaped.png'), (io.BytesIO(b'b'), 'sheet.png'),
+                      (io.BytesIO(b'c'), 'sheet.png')]}
+    resp = client.post('/api/process/batch', data=data, content_type='multipart/form-data')
+    assert resp.status_code == 200
+    assert len(set(seen)) == 3
+    assert all(os.path.dirname(p) == str(tmp_path) for p in seen)
+    assert not (tmp_path.parent.parent / 'escaped.png').exists()
+    assert sorted(os.listdir(tmp_path)) == sorted(os.path.basename(p) for p in seen)
+
+
+def test_deadline_mid_table_returns_partial_report(client, monkeypatch):
+    header = ['Roll No', 'Name', '01/08', '02/08']
+    rows = 4
+    img = np.zeros((40 * (rows + 1), 60 * len(header)), dtype=np.uint8)
+    box_rows = [[(60 * c, 40 * r, 60, 40) for c in range(len(header))] for r in range(rows + 1)]
+    deadline = deadlines.Deadline(60)
+    cells_per_row = len(header)
+
+    class ExpiringReader:
+        """Reads cells as 'P', one of them unsure, and runs the budget out after two table rows."""
+        calls = 0
+
+        def readtext(self, crop, **kwargs):
+            self.calls += 1
+            if self.calls == 2 * cells_per_row:
+                deadline.expires_at = 0
+            return [(None, 'P', 0.2 if self.calls == 3 else 0.9)]
+
+    backends = lambda stage: processing.PIPELINE._by_name[stage].backends  # noqa: E731
+    monkeypatch.setitem(backends('rasterize'), 'photo', lambda upload, ctx: processing.Page(img=img))
+    monkeypatch.setitem(backends('detect_grid'), 'opencv', lambda page, ctx: processing.Grid(
+        page=page, box_rows=box_rows, header=header, kinds=processing._classify_header(header)))
+    reader = ExpiringReader()
+    monkeypatch.setattr(processing, '_get_reader', lambda: reader)
+    monkeypatch.setattr(deadlines, 'from_request', lambda environ, headers: deadline)
+
+    data = {'file': (io.BytesIO(b'mid-table deadline'), 'sheet.png')}
+    resp = client.post('/api/process', data=data, content_type='multipart/form-data')
+    assert resp.status_code == 200
+    body = resp.get_json()['data']
+    assert body['partial'] == {'rows_read': 2, 'rows_total': rows}
+    assert len(body['full_report']) == 2
+    assert body['routing']['path'] == 'local'
+    # Escalating the unsure cell would need budget the request no longer has.
+    assert body['escalation']['skipped'] == 'deadline'
@@ -0,0 +1,79 @@
+import socket
+import time
+
+import pytest
+
+import deadlines
+
+
+@pytest.mark.parametrize('header, expected', [
+    ({}, 120.0),
+    ({'X-Request-Timeout': '30'}, 30.0),
+    ({'X-Request-Timeout': '900'}, 120.0),
+    ({'X-Request-Timeout': '-5'}, 120.0),
+    ({'X-Request-Timeout': 'soon'}, 120.0),
+])
+def test_request_timeout_header_only_shortens(header, expected, monkeypatch):
+    monkeypatch.setattr(deadlines, 'REQUEST_DEADLINE_S', 120.0)
+    assert deadlines.from_request({}, header).budget_s == expected
+
+
+def test_check_raises_when_expired_or_cancelled():
+    deadline = deadlines.Deadline(60)
+    deadline.check('rasterize')
+    deadline.cancel()
+    with pytest.raises(deadlines.DeadlineExceeded) as exc:
+        deadline.check('rasterize')
+    assert exc.value.cancelled
+
+    with pytest.raises(deadlines.DeadlineExceeded) as exc:
+        deadlines.Deadline(0).check('recognize')
+    assert not exc.value.cancelled
+    assert deadlines.timeout_error(exc.value)['stage'] == 'recognize'
+
+
+class GeventStyleSocket:
+    """Behaves like a gevent socket: recv() waits for data even with MSG_DONTWAIT."""
+
+    def __init__(self, sock):
+        self._sock = sock
+
+    def fileno(self):
+        return self._sock.fileno()
+
+    def recv(self, size, flags=0):
+        self._sock.settimeout(1.0)
+        return self._sock.recv(size, flags & ~socket.MSG_DONTWAIT)
+
+
+@pytest.fixture
+def socket_pair():
+    server, client = socket.socketpair()
+    yield GeventStyleSocket(server), client
+    server.close()
+    client.close()
+
+
+def test_probe_does_not_block_on_idle_connection(socket_pair):
+    server, _ = socket_pair
+    deadline = deadlines.from_request({'gunicorn.socket': server}, {})
+    started = time.monotonic()
+    assert not deadline.cancelled()
+    deadline.check('rasterize')
+    assert time.monotonic() - started < 0.5
+
+
+def test_probe_ignores_pending_request_data(socket_pair):
+    server, client = socket_pair
+    client.sendall(b'GET / HTTP/1.1\r\n')
+    assert not deadlines.from_request({'gunicorn.socket': server}, {}).cancelled()
+
+
+def test_probe_detects_disconnect(socket_pair):
+    server, client = socket_pair
+    client.close()
+    deadline = deadlines.from_request({'gunicorn.socket': server}, {})
+    assert deadline.cancelled()
+    with pytest.raises(deadlines.DeadlineExceeded) as exc:
+        deadline.check('recognize')
+    assert exc.value.cancelled
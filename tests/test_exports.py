@@ -0,0 +1,49 @@
+import os
+
+import pytest
+
+import exports
+
+
+@pytest.fixture
+def reports_folder(tmp_path, monkeypatch):
+    monkeypatch.setattr(exports, 'REPORTS_FOLDER', str(tmp_path))
+    return tmp_path
+
+
+def _results(rows=1):
+    return {'dates': ['01/08'], 'full_report': [{'Roll No': str(i), '01/08': 'Present'} for i in range(rows)]}
+
+
+def test_export_report_errors_carry_status(reports_folder):
+    report_id = exports.save_report(_results())
+    assert exports.export_report('0' * 32, 'csv')['status'] == 404
+    assert exports.export_report(report_id, 'docx')['status'] == 400
+
+
+def test_stream_csv_round_trip(reports_folder):
+    report_id = exports.save_report(_results(rows=3))
+    chunks, mimetype = exports.export_report(report_id, 'csv')
+    lines = b''.join(chunks).decode().splitlines()
+    assert mimetype == 'text/csv'
+    assert lines[0].startswith('Roll No,Student ID,Name,01/08,Total Lectures')
+    assert len(lines) == 4
+
+
+def test_save_report_keeps_newest_max_count(reports_folder, monkeypatch):
+    monkeypatch.setattr(exports, 'REPORTS_MAX_AGE_DAYS', 0)
+    monkeypatch.setattr(exports, 'REPORTS_MAX_COUNT', 2)
+    ids = []
+    for i in range(4):
+        ids.append(exports.save_report(_results()))
+        os.utime(reports_folder / f"{ids[-1]}.jsonl", (1000 + i, 1000 + i))
+    exports.prune_reports()
+    assert sorted(os.listdir(reports_folder)) == sorted(f"{r}.jsonl" for r in ids[-2:])
+
+
+def test_prune_reports_drops_old_reports(reports_folder, monkeypatch):
+    monkeypatch.setattr(exports, 'REPORTS_MAX_AGE_DAYS', 1)
+    old = exports.save_report(_results())
+    os.utime(reports_folder / f"{old}.jsonl", (0, 0))
+    fresh = exports.save_report(_results())
+    assert os.listdir(reports_folder) == [f"{fresh}.jsonl"]
@@ -0,0 +1,126 @@
+import os
+
+import pytest
+
+np = pytest.importorskip('numpy')
+pytest.importorskip('cv2')
+
+import layout_cache  # noqa: E402
+
+COLS = (0, 120, 380, 480, 580, 680, 780)
+KINDS = ['roll', 'name', 'date', 'date', 'date', 'date']
+
+
+@pytest.fixture(autouse=True)
+def cache_folder(tmp_path, monkeypatch):
+    monkeypatch.setattr(layout_cache, 'LAYOUT_CACHE', True)
+    monkeypatch.setattr(layout_cache, 'LAYOUT_CACHE_FOLDER', str(tmp_path))
+    monkeypatch.setattr(layout_cache, '_templates', {})
+    return tmp_path
+
+
+def _sheet(row_h=40, rows=20, cols=COLS, dx=0, dy=0):
+    """Binarized (lines = 255) ruled table on a 1000x900 page."""
+    img = np.zeros((1000, 900), dtype=np.uint8)
+    for r in range(rows + 1):
+        y = 40 + dy + r * row_h
+        img[y:y + 3, 40 + dx:40 + dx + cols[-1]] = 255
+    for c in cols:
+        x = 40 + dx + c
+        img[40 + dy:40 + dy + rows * row_h + 3, x:x + 3] = 255
+    return img
+
+
+def _box_rows(row_h=40, rows=20, cols=COLS):
+    return [[(40 + a, 40 + r * row_h, b - a, row_h) for a, b in zip(cols, cols[1:])] for r in range(rows)]
+
+
+# ---------- _best_shift ----------
+
+def test_best_shift_finds_offset():
+    ref = np.zeros(100)
+    ref[[10, 30, 50, 70]] = 5
+    cur = np.roll(ref, 3)
+    shift, score = layout_cache._best_shift(ref, cur)
+    assert shift == 3
+    assert score == pytest.approx(1.0)
+
+
+def test_best_shift_ignores_flat_profiles():
+    assert layout_cache._best_shift(np.zeros(50), np.zeros(50)) == (0, -1.0)
+
+
+def test_best_shift_is_bounded():
+    ref = np.zeros(100)
+    ref[[10, 60]] = 5
+    cur = np.roll(ref, 30)
+    shift, _ = layout_cache._best_shift(ref, cur)
+    assert abs(shift) <= max(1, int(100 * layout_cache.MAX_SHIFT_FRACTION))
+
+
+# ---------- match_template ----------
+
+def test_match_template_miss_without_templates():
+    assert layout_cache.match_template('DWM', _sheet())['status'] == 'miss'
+
+
+def test_match_template_hit_shifts_boxes():
+    layout_cache.store_template('DWM', _sheet(), _box_rows(), KINDS)
+    result = layout_cache.match_template('DWM', _sheet(dx=8, dy=12))
+    assert result['status'] == 'hit'
+    assert result['shift'] == [8, 12]
+    assert result['kinds'] == KINDS
+    assert 'header' not in result
+    x, y, _, _ = result['box_rows'][0][0]
+    assert (x, y) == (48, 52)
+
+
+def test_match_template_drift_when_rulings_move(monkeypatch):
+    monkeypatch.setattr(layout_cache, 'LAYOUT_HASH_DISTANCE', 64)
+    layout_cache.store_template('DWM', _sheet(), _box_rows(), KINDS)
+    moved = _sheet(row_h=44, rows=18, cols=(0, 200, 300, 420, 520, 660, 780))
+    assert layout_cache.match_template('DWM', moved)['status'] == 'drift'
+
+
+def test_templates_persist_per_subject(cache_folder, monkeypatch):
+    layout_cache.store_template('DWM', _sheet(), _box_rows(), KINDS)
+    monkeypatch.setattr(layout_cache, '_templates', {})
+    assert layout_cache.match_template('DWM', _sheet())['status'] == 'hit'
+    assert layout_cache.match_template('AI', _sheet())['status'] == 'miss'
+
+
+def test_reloads_templates_written_by_another_worker(cache_folder):
+    assert layout_cache.match_template('DWM', _sheet())['status'] == 'miss'
+    # Another worker stores a template: this worker's cached (empty) list is stale.
+    other = dict(layout_cache._templates)
+    layout_cache._templates.clear()
+    layout_cache.store_template('DWM', _sheet(), _box_rows(), KINDS)
+    layout_cache._templates.clear()
+    layout_cache._templates.update(other)
+    assert layout_cache.match_template('DWM', _sheet())['status'] == 'hit'
+
+
+def test_store_keeps_templates_saved_by_other_workers(cache_folder, monkeypatch):
+    monkeypatch.setattr(layout_cache, 'LAYOUT_HASH_DISTANCE', 64)
+    moved = _sheet(row_h=44, rows=18, cols=(0, 200, 300, 420, 520, 660, 780))
+    layout_cache.store_template('DWM', _sheet(), _box_rows(), KINDS)
+    stale = dict(layout_cache._templates)
+    # Another worker adds a second layout for the subject ...
+    layout_cache._templates.clear()
+    layout_cache.store_template('DWM', moved, _box_rows(row_h=44, rows=18), KINDS)
+    # ... and this worker, still holding the old list, stores a third.
+    layout_cache._templates.clear()
+    layout_cache._templates.update(stale)
+    layout_cache.store_template('DWM', _sheet(dx=8, dy=12), _box_rows(), KINDS)
+    layout_cache._templates.clear()
+    assert len(layout_cache._load_subject('DWM')) == 3
+    assert layout_cache.match_template('DWM', moved)['status'] == 'hit'
+    assert not [f for f in os.listdir(cache_folder) if f.endswith('.tmp')]
+
+
+def test_store_template_write_failure_is_best_effort(tmp_path, monkeypatch):
+    blocker = tmp_path / 'not_a_dir'
+    blocker.write_text('')
+    monkeypatch.setattr(layout_cache, 'LAYOUT_CACHE_FOLDER', str(blocker / 'layouts'))
+    layout_cache.store_template('DWM', _sheet(), _box_rows(), KINDS)
+    assert layout_cache.match_template('DWM', _sheet())['status'] == 'hit'
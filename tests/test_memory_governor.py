@@ -0,0 +1,34 @@
+import memory_governor
+
+MB = 1024 * 1024
+
+
+def test_job_admission_counts_idle_rss_once(monkeypatch):
+    monkeypatch.setattr(memory_governor, 'WORKER_MEMORY_BUDGET_MB', 1000)
+    rss = [400 * MB]
+    monkeypatch.setattr(memory_governor, 'current_rss_bytes', lambda: rss[0])
+
+    with memory_governor.job(300 * MB) as first:
+        assert first is None
+        # The first job's allocations are now resident; they must not be
+        # counted again on top of its reservation.
+        rss[0] = 700 * MB
+        with memory_governor.job(250 * MB) as second:
+            assert second is None
+        with memory_governor.job(350 * MB) as third:
+            assert third.get('error')
+    assert memory_governor.status()['in_flight'] == 0
+
+
+def test_idle_worker_admits_oversized_job(monkeypatch):
+    monkeypatch.setattr(memory_governor, 'WORKER_MEMORY_BUDGET_MB', 10)
+    with memory_governor.job(100 * MB) as rejected:
+        assert rejected is None
+
+
+def test_decode_reduction(monkeypatch):
+    monkeypatch.setattr(memory_governor, 'MAX_PAGE_PIXELS', 1_000_000)
+    assert memory_governor.decode_reduction(1000, 1000) == 1
+    assert memory_governor.decode_reduction(2000, 2000) == 2
+    assert memory_governor.decode_reduction(4000, 3000) == 4
+    assert memory_governor.decode_reduction(12000, 9000) == 8
@@ -0,0 +1,119 @@
+from dataclasses import dataclass
+
+import pytest
+
+from deadlines import Deadline, DeadlineExceeded
+from pipeline import Pipeline, Stage, RunContext
+
+
+@dataclass
+class Value:
+    steps: tuple = ()
+    partial: dict | None = None
+
+    @property
+    def cacheable(self) -> bool:
+        return self.partial is None
+
+
+def _pipeline(calls, expire_after=None, partial_at=None, deadline=None):
+    """a -> b (cached by ctx.path) -> c -> d; each backend appends its name."""
+    pipe = Pipeline([Stage(name, Value, Value, 'x') for name in 'abcd'], cache_size=8)
+    for name in 'abcd':
+        def backend(value, ctx, name=name):
+            calls.append(name)
+            partial = value.partial
+            if name == partial_at:
+                partial = {'rows_read': 1}
+            if name == expire_after:
+                deadline.expires_at = 0
+            return Value(steps=value.steps + (name,), partial=partial)
+        pipe.backend(name, 'x', cache_key=(lambda ctx: ctx.path) if name == 'b' else None)(backend)
+    return pipe
+
+
+def test_runs_every_stage_in_order():
+    calls = []
+    out = _pipeline(calls).run(Value(), RunContext(path='p'))
+    assert out.steps == ('a', 'b', 'c', 'd')
+    assert calls == ['a', 'b', 'c', 'd']
+
+
+def test_cache_jumps_ahead_to_latest_cached_stage():
+    calls = []
+    pipe = _pipeline(calls)
+    pipe.run(Value(), RunContext(path='p'))
+    calls.clear()
+    ctx = RunContext(path='p')
+    out = pipe.run(Value(), ctx)
+    assert calls == ['c', 'd']
+    assert ctx.cache_hits == ['b']
+    assert out.steps == ('a', 'b', 'c', 'd')
+
+    calls.clear()
+    pipe.run(Value(), RunContext(path='other'))
+    assert calls == ['a', 'b', 'c', 'd']
+
+
+def test_partial_outputs_are_not_cached():
+    calls = []
+    pipe = _pipeline(calls, partial_at='b')
+    pipe.run(Value(), RunContext(path='p'))
+    calls.clear()
+    pipe.run(Value(), RunContext(path='p'))
+    assert calls == ['a', 'b', 'c', 'd']
+
+
+def test_start_and_stop_select_stages():
+    calls = []
+    out = _pipeline(calls).run(Value(), RunContext(path='p'), start='b', stop='c')
+    assert out.steps == ('b', 'c')
+
+
+def test_error_dict_stops_the_run():
+    calls = []
+    pipe = _pipeline(calls)
+    pipe.backend('b', 'x')(lambda value, ctx: {"error": "no grid"})
+    assert pipe.run(Value(), RunContext(path='p')) == {"error": "no grid"}
+    assert 'c' not in calls
+
+
+def test_expired_deadline_stops_before_next_stage():
+    calls = []
+    deadline = Deadline(60)
+    pipe = _pipeline(calls, expire_after='b', deadline=deadline)
+    with pytest.raises(DeadlineExceeded) as exc:
+        pipe.run(Value(), RunContext(path='p', deadline=deadline))
+    assert exc.value.stage == 'c'
+    assert calls == ['a', 'b']
+
+
+def test_partial_value_finishes_after_deadline():
+    # The budget runs out while 'b' reads its rows: 'b' returns what it has
+    # and the remaining stages still turn it into a result.
+    calls = []
+    deadline = Deadline(60)
+    pipe = _pipeline(calls, expire_after='b', partial_at='b', deadline=deadline)
+    out = pipe.run(Value(), RunContext(path='p', deadline=deadline))
+    assert out.steps == ('a', 'b', 'c', 'd')
+    assert out.partial == {'rows_read': 1}
+
+
+def test_partial_value_still_stops_on_disconnect():
+    calls = []
+    deadline = Deadline(60)
+    pipe = _pipeline(calls, expire_after='b', partial_at='b', deadline=deadline)
+    pipe.backend('b', 'x')(lambda value, ctx: (deadline.cancel(), Value(partial={'rows_read': 1}))[1])
+    with pytest.raises(DeadlineExceeded) as exc:
+        pipe.run(Value(), RunContext(path='p', deadline=deadline))
+    assert exc.value.cancelled
+
+
+def test_hooks_see_every_stage():
+    seen = []
+    pipe = _pipeline([])
+    pipe.add_hook(lambda stage, backend, elapsed, ctx: seen.append((stage, backend)))
+    ctx = RunContext(path='p')
+    pipe.run(Value(), ctx)
+    assert seen == [(s, 'x') for s in 'abcd']
+    assert set(ctx.timings_ms) == set('abcd')
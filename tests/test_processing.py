@@ -0,0 +1,433 @@
+import threading
+import time
+
+import pytest
+
+np = pytest.importorskip('numpy')
+pytest.importorskip('cv2')
+pytest.importorskip('fitz')
+pytest.importorskip('easyocr')
+pytest.importorskip('google.generativeai')
+
+import processing  # noqa: E402
+from pipeline import RunContext  # noqa: E402
+
+
+class FakeReader:
+    """Stands in for easyocr.Reader: every cell reads as `text`."""
+
+    def __init__(self, text='P', conf=0.9):
+        self.text = text
+        self.conf = conf
+        self.calls = 0
+        self.decoders = []
+
+    def readtext(self, crop, **kwargs):
+        self.calls += 1
+        self.decoders.append(kwargs.get('decoder'))
+        return [(None, self.text, self.conf)]
+
+
+def _grid(header, rows=2):
+    img = np.zeros((40 * (rows + 1), 60 * len(header)), dtype=np.uint8)
+    box_rows = [[(60 * c, 40 * r, 60, 40) for c in range(len(header))] for r in range(rows + 1)]
+    return processing.Grid(page=processing.Page(img=img), box_rows=box_rows,
+                           header=header, kinds=processing._classify_header(header))
+
+
+# ---------- _classify_header ----------
+
+@pytest.mark.parametrize('header, expected', [
+    (['Roll No', 'Name', '01/08', '02/08'], ['roll', 'name', 'date', 'date']),
+    (['Roll No', 'Student ID', 'Name', '01/08'], ['roll', 'id', 'name', 'date']),
+    (['Student ID', 'Name', '01/08'], ['id', 'name', 'date']),
+    (['Roll No', 'Student ID', '01/08'], ['roll', 'id', 'date']),
+    (['Sr No', 'Roll No', 'Name', '01/08'], ['skip', 'roll', 'name', 'date']),
+    (['S.No.', 'Name', '01/08'], ['skip', 'name', 'date']),
+    (['', '', '01/08'], ['roll', 'name', 'date']),
+    (['Name', '', '01/08'], ['name', 'roll', 'date']),
+    (['Roll No', 'Name', 'Remarks', '01/08'], ['roll', 'name', 'skip', 'date']),
+    (['Sr No', 'Roll No', 'Student ID', 'Name', '01/08'], ['skip', 'roll', 'id', 'name', 'date']),
+    (['Roll No', 'Name', 'Mon', 'Tue'], ['roll', 'name', 'date', 'date']),
+    (['Roll No', 'Name', '12-Aug', '12-Sep'], ['roll', 'name', 'date', 'date']),
+    ([], []),
+])
+def test_classify_header(header, expected):
+    assert processing._classify_header(header) == expected
+
+
+def test_classify_header_only_reads_leading_labels():
+    header = ['Roll No', 'Name', '01/08', 'Name']
+    assert processing._classify_header(header)[3] == 'date'
+
+
+def test_unique_labels():
+    assert processing._unique_labels(['12-', '12-', '', '12-']) == ['12-', '12- (2)', 'Lecture 3', '12- (3)']
+
+
+def test_read_header_reads_text_until_first_date(monkeypatch):
+    labels = iter(['Sr No', 'Roll No', 'Student ID', 'Name', '12-Aug', '12-Sep'])
+
+    class HeaderReader(FakeReader):
+        def readtext(self, crop, **kwargs):
+            super().readtext(crop, **kwargs)
+            return [(None, next(labels), 0.9)]
+
+    reader = HeaderReader()
+    monkeypatch.setattr(processing, '_get_reader', lambda: reader)
+    grid = _grid(['x'] * 6)
+    header = processing._read_header(grid.page.img, grid.box_rows[0])
+    assert header == ['Sr No', 'Roll No', 'Student ID', 'Name', '12-Aug', '12-Sep']
+    assert reader.decoders == ['beamsearch'] * 5 + ['greedy']
+
+
+# ---------- recognize ----------
+
+@pytest.mark.parametrize('header', [
+    ['Student ID', 'Name', '01/08', '02/08'],
+    ['Roll No', 'Student ID', '01/08', '02/08'],
+    ['Sr No', 'Roll No', 'Name', '01/08', '02/08'],
+])
+def test_recognize_always_has_key_columns(header, monkeypatch):
+    reader = FakeReader()
+    monkeypatch.setattr(processing, '_get_reader', lambda: reader)
+    table = processing._recognize_easyocr(_grid(header), RunContext(path='sheet.pdf'))
+    assert list(table.df.columns) == ['Roll No', 'Student ID', 'Name', '01/08', '02/08']
+    assert len(table.df) == 2
+
+
+def test_recognize_with_duplicate_date_labels(monkeypatch):
+    reader = FakeReader()
+    monkeypatch.setattr(processing, '_get_reader', lambda: reader)
+    ctx = RunContext(path='sheet.pdf')
+    table = processing._recognize_easyocr(_grid(['Roll No', 'Name', '12-', '12-']), ctx)
+    assert list(table.df.columns) == ['Roll No', 'Student ID', 'Name', '12-', '12- (2)']
+    table = processing._classify_marks(table, ctx)
+    assert (table.df['12- (2)'] == 'Present').all()
+
+
+def test_recognize_does_not_read_serial_column(monkeypatch):
+    reader = FakeReader()
+    monkeypatch.setattr(processing, '_get_reader', lambda: reader)
+    processing._recognize_easyocr(_grid(['Sr No', 'Roll No', 'Name', '01/08']), RunContext(path='sheet.pdf'))
+    assert reader.calls == 2 * 3
+
+
+def test_recognize_without_grid_skips_full_page_read(monkeypatch):
+    reader = FakeReader()
+    monkeypatch.setattr(processing, '_get_reader', lambda: reader)
+    page = processing.Page(img=np.zeros((50, 50), dtype=np.uint8))
+    result = processing._recognize_easyocr(processing.Grid(page=page, box_rows=[]), RunContext(path='sheet'))
+    assert result.get('error')
+    assert reader.calls == 0
+
+
+def test_layout_hit_rereads_date_headers(monkeypatch):
+    reader = FakeReader(text='08/09')
+    monkeypatch.setattr(processing, '_get_reader', lambda: reader)
+    grid = _grid(['Roll No', 'Name', '01/08', '02/08'])
+    hit = {'status': 'hit', 'box_rows': grid.box_rows, 'kinds': grid.kinds}
+    monkeypatch.setattr(processing.layout_cache, 'match_template', lambda subject, img_bin: dict(hit))
+    result = processing._detect_grid_opencv(grid.page, RunContext(path='sheet.pdf', subject='DWM'))
+    assert result.header == ['', '', '08/09', '08/09']
+    assert reader.decoders == ['greedy', 'greedy']
+
+
+# ---------- Gemini sheet batching ----------
+
+def test_split_batch_response_orders_sheets():
+    text = '```json\n{"sheets": [{"sheet": 1, "dates": ["b"], "students": []},' \
+           ' {"sheet": 0, "dates": ["a"], "students": [{"name": "X"}]}]}\n```'
+    first, second = processing._split_batch_response(text, 2)
+    assert first == {'dates': ['a'], 'students': [{'name': 'X'}]}
+    assert second == {'dates': ['b'], 'students': []}
+
+
+def test_split_batch_response_missing_sheet():
+    results = processing._split_batch_response('{"sheets": [{"sheet": 0, "dates": [], "students": []}]}', 2)
+    assert 'error' not in results[0]
+    assert 'no result for sheet 1' in results[1]['error']
+
+
+def test_split_batch_response_keeps_first_duplicate():
+    text = '{"sheets": [{"sheet": 0, "dates": ["a"], "students": []}, {"sheet": 0, "dates": ["b"], "students": []}]}'
+    assert processing._split_batch_response(text, 1) == [{'dates': ['a'], 'students': []}]
+
+
+@pytest.mark.parametrize('entry', [
+    '{"sheet": 0, "dates": "a", "students": []}',
+    '{"sheet": 0, "dates": [], "students": ["X"]}',
+    '{"sheet": 0, "dates": []}',
+])
+def test_split_batch_response_malformed_entry(entry):
+    text = '{"sheets": [%s, {"sheet": 1, "dates": [], "students": []}]}' % entry
+    results = processing._split_batch_response(text, 2)
+    assert 'malformed result for sheet 0' in results[0]['error']
+    assert 'error' not in results[1]
+
+
+@pytest.mark.parametrize('text', [
+    'not json',
+    '["sheets"]',
+    '{"sheets": [{"sheet": "x"}, {"sheet": 7}, "junk"]}',
+])
+def test_split_batch_response_unusable_answer(text):
+    results = processing._split_batch_response(text, 2)
+    assert len(results) == 2
+    assert all(r.get('error') for r in results)
+
+
+def test_batch_deadline_is_latest_member_without_cancellation():
+    leader = processing.Deadline(5)
+    leader.cancel()
+    shared = processing._batch_deadline([leader, processing.Deadline(60)])
+    assert shared.remaining() > 50
+    assert not shared.cancelled()
+    assert processing._batch_deadline([leader, None]) is None
+
+
+def test_batcher_leader_cancellation_does_not_fail_followers(monkeypatch):
+    sent = []
+
+    def fake_extract(images, deadline):
+        if deadline is not None:
+            deadline.check('gemini')
+        sent.append(len(images))
+        return [{'dates': ['a'], 'students': [], 'n': i} for i in range(len(images))]
+
+    monkeypatch.setattr(processing, 'GEMINI_BATCH_WINDOW_MS', 300)
+    monkeypatch.setattr(processing, '_extract_sheets_with_gemini', fake_extract)
+    batcher = processing._SheetBatcher()
+    leader_deadline = processing.Deadline(60)
+    leader_deadline.cancel()
+    results = {}
+
+    leader = threading.Thread(target=lambda: results.update(leader=batcher.submit('a', leader_deadline)))
+    follower = threading.Thread(target=lambda: results.update(follower=batcher.submit('b', processing.Deadline(60))))
+    leader.start()
+    time.sleep(0.05)
+    follower.start()
+    leader.join(5)
+    follower.join(5)
+    assert sent == [2]
+    assert results['follower']['n'] == 1
+
+
+def test_batching_auto_follows_worker_type(monkeypatch):
+    monkeypatch.setattr(processing, 'GEMINI_BATCH', 'auto')
+    monkeypatch.delenv('WORKER_CONCURRENT', raising=False)
+    assert not processing._batching_enabled()
+    monkeypatch.setenv('WORKER_CONCURRENT', '1')
+    assert processing._batching_enabled()
+    monkeypatch.setattr(processing, 'GEMINI_BATCH', '0')
+    assert not processing._batching_enabled()
+
+
+# ---------- Photo preprocessing and routing ----------
+
+def _ruled_sheet(angle=0.0, background=235):
+    import cv2
+    sheet = np.full((600, 450), background, dtype=np.uint8)
+    for y in range(40, 560, 40):
+        cv2.line(sheet, (30, y), (420, y), 0, 2)
+    for x in (30, 130, 420):
+        cv2.line(sheet, (x, 40), (x, 520), 0, 2)
+    if angle:
+        M = cv2.getRotationMatrix2D((225, 300), angle, 1.0)
+        sheet = cv2.warpAffine(sheet, M, (450, 600), borderValue=background)
+    return sheet
+
+
+@pytest.mark.parametrize('angle', [0.0, 3.0, -2.0])
+def test_estimate_skew(angle):
+    # A counter-clockwise rotation shows up as a negative line angle.
+    assert processing._estimate_skew(_ruled_sheet(angle)) == pytest.approx(-angle, abs=0.5)
+
+
+def test_preprocess_photo_flattens_sheet_on_desk(tmp_path):
+    import cv2
+    desk = np.full((900, 800), 40, dtype=np.uint8)
+    corners = np.float32([[0, 0], [449, 0], [449, 599], [0, 599]])
+    placed = np.float32([[150, 100], [620, 140], [660, 800], [110, 760]])
+    M = cv2.getPerspectiveTransform(corners, placed)
+    photo = cv2.warpPerspective(_ruled_sheet(), M, (800, 900), dst=desk, borderMode=cv2.BORDER_TRANSPARENT)
+    path = str(tmp_path / 'photo.png')
+    cv2.imwrite(path, photo)
+
+    page = processing.preprocess_photo(path)
+    H, W = page.shape
+    assert H < 900 and W < 800
+    # Only the sheet is left: no dark desk along the borders.
+    assert min(page[:5].mean(), page[-5:].mean(), page[:, :5].mean(), page[:, -5:].mean()) > 150
+
+
+def test_preprocess_photo_deskews(tmp_path):
+    import cv2
+    path = str(tmp_path / 'tilted.png')
+    cv2.imwrite(path, _ruled_sheet(angle=3.0, background=255))
+    assert abs(processing._estimate_skew(processing.preprocess_photo(path))) < 0.5
+
+
+def test_preprocess_photo_unreadable_file(tmp_path):
+    path = tmp_path / 'broken.png'
+    path.write_bytes(b'not an image')
+    assert processing.preprocess_photo(str(path)).get('error')
+
+
+@pytest.fixture
+def local_photo(monkeypatch):
+    """Stub rasterize/detect_grid for photos; returns a setter for the reader and grid."""
+    header = ['Roll No', 'Name', '01/08']
+    grid = _grid(header)
+    state = {'box_rows': grid.box_rows}
+    backends = lambda stage: processing.PIPELINE._by_name[stage].backends  # noqa: E731
+    monkeypatch.setitem(backends('rasterize'), 'photo',
+                        lambda upload, ctx: processing.Page(img=grid.page.img))
+    monkeypatch.setitem(backends('detect_grid'), 'opencv', lambda page, ctx: processing.Grid(
+        page=page, box_rows=state['box_rows'], header=header, kinds=grid.kinds))
+    monkeypatch.setattr(processing.PIPELINE, '_cache_size', 0)
+    monkeypatch.setattr(processing, 'CELL_ESCALATION', False)
+
+    def configure(conf=0.9, box_rows=None):
+        reader = FakeReader(conf=conf)
+        monkeypatch.setattr(processing, '_get_reader', lambda: reader)
+        if box_rows is not None:
+            state['box_rows'] = box_rows
+        return RunContext(path='sheet.png')
+    return configure
+
+
+def test_route_photo_locally_trusts_confident_read(local_photo):
+    ctx = local_photo(conf=0.9)
+    results, routing, local_table = processing._route_photo_locally(processing.Upload('sheet.png', 'photo'), ctx)
+    assert routing['path'] == 'local'
+    assert routing['confidence'] == pytest.approx(0.9)
+    assert len(results['full_report']) == 2
+
+
+def test_route_photo_locally_defers_low_confidence_to_gemini(local_photo, monkeypatch):
+    monkeypatch.setattr(processing, 'LOCAL_OCR_MIN_CONFIDENCE', 0.6)
+    ctx = local_photo(conf=0.3)
+    results, routing, local_table = processing._route_photo_locally(processing.Upload('sheet.png', 'photo'), ctx)
+    assert results is None
+    assert routing['path'] == 'gemini'
+    assert local_table is not None
+
+
+def test_route_photo_locally_without_grid(local_photo):
+    ctx = local_photo(box_rows=[])
+    results, routing, local_table = processing._route_photo_locally(processing.Upload('sheet.png', 'photo'), ctx)
+    assert results is None and local_table is None
+    assert routing['confidence'] is None
+
+
+def test_gemini_failure_falls_back_to_local_table(local_photo, monkeypatch):
+    ctx = local_photo(conf=0.3)
+    results, routing, local_table = processing._route_photo_locally(processing.Upload('sheet.png', 'photo'), ctx)
+    results = processing._finish_photo({"error": "Gemini unavailable"}, routing, local_table, ctx)
+    assert results['routing']['path'] == 'local'
+    assert results['routing']['fallback_reason'] == 'Gemini unavailable'
+
+
+# ---------- Cell escalation ----------
+
+class ScriptedReader(FakeReader):
+    """Reads every cell as 'P'; the calls listed in `unsure` return (text, 0.2)."""
+
+    def __init__(self, unsure):
+        super().__init__()
+        self.unsure = unsure
+
+    def readtext(self, crop, **kwargs):
+        super().readtext(crop, **kwargs)
+        if self.calls in self.unsure:
+            return [(None, self.unsure[self.calls], 0.2)]
+        return [(None, 'P', 0.9)]
+
+
+def _escalation_table(header, unsure, monkeypatch):
+    monkeypatch.setattr(processing, '_get_reader', lambda: ScriptedReader(unsure))
+    ctx = RunContext(path='sheet.pdf')
+    table = processing._recognize_easyocr(_grid(header), ctx)
+    df = table.df.copy()
+    for c in df.columns[3:]:
+        df[c] = df[c].apply(lambda v: 'Present' if v == 'P' else 'Absent')
+    return df, table.uncertain
+
+
+@pytest.fixture
+def escalation_on(monkeypatch):
+    monkeypatch.setattr(processing, 'CELL_ESCALATION', True)
+
+
+def test_escalation_merges_answers_past_skipped_serial_column(escalation_on, monkeypatch):
+    # Reads per row: Roll No, Name, 01/08 (Sr No is skipped). Row 1's name and
+    # row 0's mark are unsure.
+    df, uncertain = _escalation_table(['Sr No', 'Roll No', 'Name', '01/08'], {3: '?', 5: 'Asa'}, monkeypatch)
+    assert [(c['row'], c['kind']) for c in uncertain] == [(0, 'date'), (1, 'name')]
+    stats = processing.escalate_uncertain_cells(df, uncertain, resolver=lambda cells: {
+        i: {'date': 'A', 'name': 'Asha'}[c['kind']] for i, c in enumerate(cells)})
+    assert stats['resolved'] == 2
+    assert df.loc[0, '01/08'] == 'Absent'
+    assert df.loc[1, 'Name'] == 'Asha'
+    assert list(df['Roll No']) == ['P', 'P']
+
+
+def test_escalation_without_student_id_column(escalation_on, monkeypatch):
+    # Reads per row: Roll No, Name, 01/08, 02/08. Row 0's roll number and
+    # row 1's second mark are unsure.
+    df, uncertain = _escalation_table(['Roll No', 'Name', '01/08', '02/08'], {1: '1O', 8: '~'}, monkeypatch)
+    processing.escalate_uncertain_cells(df, uncertain, resolver=lambda cells: {
+        i: {'roll': 'No. 10', 'date': 'P'}[c['kind']] for i, c in enumerate(cells)})
+    assert df.loc[0, 'Roll No'] == '10'
+    assert df.loc[1, '02/08'] == 'Present'
+    assert list(df['Student ID']) == ['', '']
+
+
+def test_escalation_ignores_out_of_range_answers(escalation_on, monkeypatch):
+    df, uncertain = _escalation_table(['Roll No', 'Name', '01/08'], {2: 'Asa'}, monkeypatch)
+    before = df.copy()
+    stats = processing.escalate_uncertain_cells(df, uncertain, resolver=lambda cells: {5: 'Asha', -1: 'X'})
+    assert stats['resolved'] == 0
+    assert df.equals(before)
+
+
+def test_escalation_resolver_error(escalation_on, monkeypatch):
+    df, uncertain = _escalation_table(['Roll No', 'Name', '01/08'], {2: 'Asa'}, monkeypatch)
+    before = df.copy()
+    stats = processing.escalate_uncertain_cells(df, uncertain, resolver=lambda cells: {"error": "quota"})
+    assert stats['error'] == 'quota'
+    assert stats['sent'] == 1 and stats['resolved'] == 0
+    assert df.equals(before)
+
+
+def test_escalation_sends_lowest_confidence_cells(escalation_on, monkeypatch):
+    monkeypatch.setattr(processing, 'CELL_ESCALATION_MAX', 1)
+    cells = [{'row': 0, 'col_pos': 2, 'kind': 'name', 'text': t, 'confidence': c,
+              'crop': np.zeros((10, 10), dtype=np.uint8)} for t, c in (('a', 0.4), ('b', 0.1))]
+    seen = []
+    processing.escalate_uncertain_cells(processing.pd.DataFrame([['', '', '']]), cells,
+                                        resolver=lambda sent: seen.extend(c['text'] for c in sent) or {})
+    assert seen == ['b']
+
+
+def test_build_mosaics_packs_cells():
+    cells = [{'crop': np.full((30, 80), 128, dtype=np.uint8)} for _ in range(processing.MOSAIC_CELLS + 5)]
+    mosaics = processing._build_mosaics(cells)
+    assert len(mosaics) == 2
+    assert mosaics[0].size == (processing.MOSAIC_WIDTH, processing.MOSAIC_TILE_HEIGHT * processing.MOSAIC_CELLS)
+    assert mosaics[1].size[1] == processing.MOSAIC_TILE_HEIGHT * 5
+
+
+def test_preprocess_photo_decodes_oversized_photo_reduced(tmp_path, monkeypatch):
+    import cv2
+    path = str(tmp_path / 'big.jpg')
+    cv2.imwrite(path, np.full((2000, 1600), 255, dtype=np.uint8))
+    monkeypatch.setattr(processing.memory_governor, 'MAX_PAGE_PIXELS', 500_000)
+    flags = []
+    real_imread = cv2.imread
+    monkeypatch.setattr(processing.cv2, 'imread', lambda p, flag: flags.append(flag) or real_imread(p, flag))
+
+    page = processing.preprocess_photo(path)
+    assert flags == [cv2.IMREAD_REDUCED_GRAYSCALE_4]
+    assert page.shape[0] * page.shape[1] <= 500_000